@@ -0,0 +1,237 @@
+#!/usr/bin/python
+
+# benchmark tau commands against synthetic stores
+# stores are built with the simulate.py generators
+# results are written as JSON and can be checked against a baseline
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import simulate
+import tau
+
+TAU_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tau.py")
+
+# Name -> tau command line, {id} is replaced by an open task id
+COMMANDS = {
+    "add": ["add", "-t", "bench task", "--desc", "bench", "-p", "bench",
+            "-r", "1"],
+    "list": ["list"],
+    "show": ["show", "{id}"],
+    "start": ["start", "{id}"],
+    "comment": ["comment", "{id}", "-c", "bench comment", "-a", "bench"],
+    "log": ["log"],
+}
+
+def open_settings(path):
+    config = tau.Config(path)
+    config.load()
+    return tau.Settings(config)
+
+# Months of history in the stores. Only this one, so every task is in
+# the month list and show work on.
+HISTORY_MONTHS = 1
+
+# Fill path with count tasks generated like simulate.py does, created
+# oldest first and each trying events_per_task state changes. Everything
+# is written in one go at the end.
+def build_store(path, count, events_per_task, seed):
+    import shutil
+    # Left by a run with other settings
+    shutil.rmtree(path, ignore_errors=True)
+    for subdir in ("task", "month", "journal"):
+        tau.make_path(path, subdir)
+    settings = open_settings(path)
+
+    plans = simulate.plan_tasks(seed, count, events_per_task,
+                                HISTORY_MONTHS, os.cpu_count())
+    simulate.write_tasks(plans, settings)
+
+    with open(os.path.join(path, "bench.json"), "w") as f:
+        json.dump(store_meta(count, events_per_task, seed), f)
+
+def store_meta(count, events_per_task, seed):
+    return {"tasks": count, "events_per_task": events_per_task,
+            "seed": seed, "months": HISTORY_MONTHS}
+
+def store_is_built(path, count, events_per_task, seed):
+    try:
+        with open(os.path.join(path, "bench.json"), "r") as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        return False
+    return meta == store_meta(count, events_per_task, seed)
+
+def pick_open_id(path):
+    settings = open_settings(path)
+    try:
+        month_tks = tau.MonthTasks.load(datetime.datetime.now(), settings)
+        ids = month_tks.ids
+    except FileNotFoundError:
+        ids = {}
+    if not ids:
+        tau.error(f"no open task in {path} to run show, start and comment "
+                  f"on, try fewer --events-per-task or another --seed")
+    return min(ids)
+
+def command_line(name, id):
+    return [arg.replace("{id}", str(id)) for arg in COMMANDS[name]]
+
+# Best and median of several runs of func, in seconds. None if the
+# command can't run here, eg. tau log without numpy.
+def measure(func, repeat, setup=None):
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        try:
+            func()
+        except SystemExit as e:
+            if e.code:
+                return None
+        times.append(time.perf_counter() - start)
+    return {"best": min(times), "median": statistics.median(times)}
+
+# Run commands through the parser and command functions, like run_app
+# does, with a fresh Settings every time as for a new process
+def run_in_process(path, argv):
+    args = tau.make_parser().parse_args(["--no-daemon"] + argv)
+    settings = open_settings(path)
+    with contextlib.redirect_stdout(io.StringIO()):
+        args.func(args, settings)
+
+def run_subprocess(path, argv):
+    env = dict(os.environ, TAU_CONFIG_PATH=path)
+    result = subprocess.run([sys.executable, TAU_PATH, "--no-daemon"] + argv,
+                            env=env, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+    if result.returncode:
+        sys.exit(result.returncode)
+
+# The commands write, so they run against a copy. The store stays as it
+# was built and a reused --dir store doesn't grow from run to run.
+def bench_store(path, repeat):
+    import shutil
+    id = pick_open_id(path)
+    with tempfile.TemporaryDirectory(prefix="tau-bench-",
+                                     dir=os.path.dirname(path)) as temp_dir:
+        run_path = os.path.join(temp_dir, "store")
+        shutil.copytree(path, run_path)
+        return bench_commands(run_path, id, repeat)
+
+def bench_commands(path, id, repeat):
+    results = {"in_process": {}, "subprocess": {}}
+    for mode, run in (("in_process", run_in_process),
+                      ("subprocess", run_subprocess)):
+        for name in COMMANDS:
+            argv = command_line(name, id)
+            setup = None
+            if name == "start":
+                # Pause first so every start writes an event
+                pause = ["pause", str(id)]
+                setup = lambda: run_in_process(path, pause)
+            results[mode][name] = measure(lambda: run(path, argv), repeat,
+                                          setup)
+            logging.info(f"{mode} {name}: {results[mode][name]}")
+
+    settings = open_settings(path)
+    results["in_process"]["find_free_id"] = measure(
+        lambda: tau.find_free_id(settings), repeat)
+    return results
+
+# Yields (description, baseline, result) for every timing which got
+# slower than the threshold allows
+def find_regressions(results, baseline, threshold):
+    for size, modes in results["sizes"].items():
+        for mode, timings in modes.items():
+            for name, timing in timings.items():
+                try:
+                    base = baseline["sizes"][size][mode][name]
+                except KeyError:
+                    continue
+                if timing is None or base is None:
+                    continue
+                if timing["median"] > base["median"] * (1 + threshold):
+                    yield (f"{size} tasks, {mode} {name}", base["median"],
+                           timing["median"])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='bench',
+        usage='%(prog)s [options]',
+        description="time tau commands on synthetic stores"
+    )
+    parser.add_argument("-v", "--verbose",
+            action="store_const",
+            dest="loglevel", const=logging.INFO, default=logging.WARNING,
+            help="print each timing as it is measured")
+    parser.add_argument("--sizes",
+            default="1000,10000,100000",
+            help="comma separated task counts")
+    parser.add_argument("--events-per-task",
+            type=int, default=50,
+            help="state changes generated for each task")
+    parser.add_argument("--repeat",
+            type=int, default=5,
+            help="runs of each command, the median is compared")
+    parser.add_argument("--seed",
+            type=int, default=0,
+            help="random seed for the generated stores")
+    parser.add_argument("--dir",
+            default=None,
+            help="where to keep the stores, reused when they match")
+    parser.add_argument("-o", "--output",
+            default="bench.json",
+            help="file to write the results to")
+    parser.add_argument("--baseline",
+            default=None,
+            help="earlier results to compare against")
+    parser.add_argument("--threshold",
+            type=float, default=0.2,
+            help="fraction slower than the baseline counted as a regression")
+    args = parser.parse_args()
+    logging.basicConfig(level=args.loglevel)
+
+    if args.dir is None:
+        temp_dir = tempfile.TemporaryDirectory(prefix="tau-bench-")
+        store_dir = temp_dir.name
+    else:
+        store_dir = args.dir
+
+    results = {
+        "python": sys.version.split()[0],
+        "events_per_task": args.events_per_task,
+        "repeat": args.repeat,
+        "sizes": {},
+    }
+    for size in (int(size) for size in args.sizes.split(",")):
+        path = os.path.join(store_dir, str(size))
+        if not store_is_built(path, size, args.events_per_task, args.seed):
+            logging.info(f"building store of {size} tasks in {path}")
+            start = time.perf_counter()
+            build_store(path, size, args.events_per_task, args.seed)
+            logging.info(f"built in {time.perf_counter() - start:.1f}s")
+        results["sizes"][str(size)] = bench_store(path, args.repeat)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=4)
+
+    if args.baseline is not None:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        regressions = list(find_regressions(results, baseline,
+                                            args.threshold))
+        for name, before, after in regressions:
+            print(f"{name}: {before * 1000:.1f}ms -> {after * 1000:.1f}ms")
+        if regressions:
+            sys.exit(1)
@@ -7,10 +7,12 @@
 
 import argparse
 import datetime
+import json
 import os
 import logging
 import tau
 import random
+import time
 
 titles = [
     "generate fake tasks",
@@ -97,23 +99,14 @@ projects = [
         "df.crypto"
         ]
 
-def random_date():
-    day, month = random_number(), random_number()
+def random_date(rng=random):
+    day, month = random_number(rng), random_number(rng)
     year = 2021
     date = datetime.date(year, month, day)
     return date
 
-def random_number():
-    return random.randrange(1, 12)
-
-def create_task(ref_id, id, title, desc, assign, project,
-        due, rank, created_at, settings):
-    tk = tau.TaskInfo(ref_id, id, title, desc, assign,
-            project, due, rank, created_at, settings)
-    tk.save()
-    tk.activate()
-    logging.info(f"{tk}")
-    return tk
+def random_number(rng=random):
+    return rng.randrange(1, 12)
 
 def get_next_states(current_state):
     if current_state == "open":
@@ -126,20 +119,127 @@ def get_next_states(current_state):
         next_states = ["stop"]
     return next_states
 
-def get_values():
-    ref_id = tau.random_hex_string()
-    id = random_number()
-    title = random.choice(titles)
-    index = titles.index(title)
-    desc = descriptions[index]
-    assign = random.choice(assignee)
-    project = random.choice(projects)
-    due = random_date()
-    rank = random_number()
-    created_at = datetime.datetime.now()
-    settings = tau.Settings(config)
-    return (ref_id, id, title, index, desc, assign, project, due, rank,
-            created_at, settings)
+def get_values(rng=random):
+    ref_id = "%030x" % rng.getrandbits(120)
+    # Short ids are handed out by the month, this draw only keeps seeds
+    # giving the same workloads as before
+    random_number(rng)
+    title = rng.choice(titles)
+    desc = descriptions[titles.index(title)]
+    assign = rng.choice(assignee)
+    project = rng.choice(projects)
+    due = random_date(rng)
+    rank = random_number(rng)
+    return ref_id, title, desc, assign, project, due, rank
+
+# First day of the month months - 1 before now
+def history_start(now, months):
+    date = datetime.datetime.fromtimestamp(now)
+    year, month = date.year, date.month - (months - 1)
+    while month < 1:
+        year, month = year - 1, month + 12
+    return datetime.datetime(year, month, 1).timestamp()
+
+# Everything about one task, worked out in a pool process. Each task has
+# its own random generator so results don't depend on the worker count.
+# Times are spread over the months before now, so only what happens in
+# which order repeats for a seed, not when.
+def plan_task(job):
+    seed, index, events_per_task, start, now = job
+    rng = random.Random(f"{seed}-{index}")
+    ref_id, title, desc, assign, project, due, rank = get_values(rng)
+    created = rng.uniform(start, now)
+
+    events, comments = [], []
+    state, timestamp = "open", created
+    for step in range(events_per_task):
+        # Spread what is left of the history up to now
+        remaining = events_per_task - step
+        timestamp += rng.uniform(0, 2 * (now - timestamp) / (remaining + 1))
+        if rng.random() < 0.05:
+            comments.append((f"progress note {step}", timestamp))
+        next_state = rng.choice(get_next_states(state))
+        if next_state == state:
+            continue
+        events.append((next_state, timestamp))
+        state = next_state
+        if state == "stop":
+            break
+
+    return {
+        "ref_id": ref_id, "title": title, "desc": desc, "assign": assign,
+        "project": project, "due": due, "rank": rank, "created": created,
+        "events": events, "comments": comments,
+    }
+
+def plan_tasks(seed, count, events_per_task, months, workers):
+    now = time.time()
+    start = history_start(now, months)
+    jobs = [(seed, index, events_per_task, start, now)
+            for index in range(count)]
+    if workers <= 1:
+        plans = [plan_task(job) for job in jobs]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            plans = list(executor.map(plan_task, jobs,
+                                      chunksize=max(1, count // (workers * 4))))
+    # Applied oldest first, so months roll over into each other in order
+    plans.sort(key=lambda plan: plan["created"])
+    return plans
+
+def write_tasks(plans, settings):
+    with tau.TaskStore(settings):
+        for plan in plans:
+            created_at = datetime.datetime.fromtimestamp(plan["created"])
+            month_tks = tau.MonthTasks.load_or_create(created_at, settings)
+            tk = tau.TaskInfo(plan["ref_id"], month_tks.find_free_id(),
+                              plan["title"], plan["desc"], plan["assign"],
+                              plan["project"], plan["due"], plan["rank"],
+                              created_at, settings)
+            for action, timestamp in plan["events"]:
+                tk.add_event(action, timestamp)
+            for content, timestamp in plan["comments"]:
+                tk.comments.append(tau.Comment(content, plan["assign"],
+                                               timestamp))
+            tk.save()
+            tk.activate()
+            if tk.get_state() == "stop":
+                month_tks = tau.MonthTasks.load_or_create(created_at,
+                                                          settings)
+                month_tks.release_id(tk.id, tk.tk_hash())
+                month_tks.save()
+            logging.debug(f"{tk}")
+
+# The same workload as tau batch operations. Replaying it into an empty
+# store hands out the same short ids, which are tracked here the same
+# way tau does. Times are not part of the trace, replayed events happen
+# when they are applied.
+def write_trace(plans, filename):
+    ids = tau.MonthTasks(datetime.datetime.now(), None)
+    with open(filename, "w") as f:
+        def write(op):
+            f.write(json.dumps(op) + "\n")
+
+        for plan in plans:
+            id = ids.find_free_id()
+            ids.claim_id(id, plan["ref_id"])
+            write({"op": "add", "title": plan["title"], "desc": plan["desc"],
+                   "assign": plan["assign"], "project": plan["project"],
+                   "due": plan["due"].strftime("%d%m"),
+                   "rank": plan["rank"]})
+            history = ([(timestamp, "event", action)
+                        for action, timestamp in plan["events"]] +
+                       [(timestamp, "comment", content)
+                        for content, timestamp in plan["comments"]])
+            for timestamp, kind, value in sorted(history):
+                if kind == "event":
+                    write({"op": value, "id": id})
+                else:
+                    write({"op": "comment", "id": id, "comment": value,
+                           "author": plan["assign"]})
+            if plan["events"] and plan["events"][-1][0] == "stop":
+                ids.release_id(id, plan["ref_id"])
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(prog='simulator',
@@ -150,6 +250,25 @@ if __name__ == "__main__":
             action="store_const",
             dest="loglevel", const=logging.DEBUG, default=logging.WARNING,
             help="increase output verbosity"),
+    parser.add_argument("--tasks",
+            type=int, default=19,
+            help="number of tasks to generate")
+    parser.add_argument("--events-per-task",
+            type=int, default=10,
+            help="state changes tried for each task")
+    parser.add_argument("--months",
+            type=int, default=1,
+            help="months of history, ending with this one")
+    parser.add_argument("--seed",
+            type=int, default=None,
+            help=("random seed. The same seed writes the same --trace, "
+                  "the store's timestamps depend on when it runs"))
+    parser.add_argument("--workers",
+            type=int, default=os.cpu_count(),
+            help="processes generating tasks")
+    parser.add_argument("--trace",
+            default=None,
+            help="also write the workload as JSONL for tau batch")
     args = parser.parse_args()
     logging.basicConfig(level=args.loglevel)
 
@@ -157,21 +276,25 @@ if __name__ == "__main__":
         config_path = os.environ["TAU_CONFIG_PATH"]
     except KeyError:
         config_path = os.path.expanduser("~/.config/tau/")
-    
+    tau.make_path(config_path, "task")
+    tau.make_path(config_path, "month")
+    tau.make_path(config_path, "journal")
+
     config = tau.Config(config_path)
     config.load()
-    
-    current_state = "open"
-    created_at = 1001
-
-    for day_offset in range(1, 20):
-        (ref_id, id, title, index, desc, assign, project, due, rank, created_at,
-                settings) = get_values()
+    settings = tau.Settings(config)
 
-        tk = create_task(ref_id, id, title, desc, assign, project,
-            due, rank, created_at, settings)
+    seed = args.seed
+    if seed is None:
+        seed = random.randrange(2**32)
 
-        next_states = get_next_states(current_state)
-        current_state = random.choice(next_states)
-        tk.set_state(current_state)
-        logging.info(f"{tk}")
+    start = time.perf_counter()
+    plans = plan_tasks(seed, args.tasks, args.events_per_task, args.months,
+                       args.workers)
+    write_tasks(plans, settings)
+    if args.trace is not None:
+        write_trace(plans, args.trace)
+    event_count = sum(len(plan["events"]) for plan in plans)
+    print(f"Generated {len(plans)} tasks with {event_count} events over "
+          f"{args.months} months in {time.perf_counter() - start:.1f}s "
+          f"(seed {seed})")
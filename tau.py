@@ -1,22 +1,23 @@
 #!/usr/bin/python
 
+# Keep module level imports to what every command needs. Heavier modules
+# (tabulate, colorama, tempfile, calendar...) are imported by the
+# functions that use them so that e.g. "tau start 3" stays fast.
+import atexit
 import binascii
-import calendar
+import bisect
+import contextlib
 import os
 import argparse
 import datetime
-import itertools
 import json
-import hashlib
+import heapq
+import itertools
 import logging
-import pprint
-import pickle
+import socket
 import sys
-import tempfile
 import time
-from decimal import Decimal as Real
-from tabulate import tabulate
-from colorama import Fore, Back, Style
+from decimal import Decimal as Real, InvalidOperation
 
 def error(message):
     print(f"Error: {message}", file=sys.stderr)
@@ -74,20 +75,59 @@ def convert_due_date(date):
     # Now evaluate the month and year
     # DDMM format
     day, month = int(date[:2]), int(date[2:])
-    year = datetime.date.today().year
-    #print(f"{day} {month} {year}")
 
     # !!!
     # This line can throw ValueError if month or day is invalid!
     # Should be caught by validate_due_date(date)
-    due = datetime.date(year, month, day)
-
-    # Keep incrementing year for due date until it's in the future
-    now = datetime.datetime.now().date()
-    while due < now:
-        due = due.replace(year = due.year + 1)
-
-    return due
+    # 2000 was a leap year, so 29 Feb gets through
+    datetime.date(2000, month, day)
+
+    # The next time the day comes round, today included
+    today = datetime.date.today()
+    year = today.year
+    if (month, day) < (today.month, today.day):
+        year += 1
+    if (month, day) == (2, 29):
+        import calendar
+        while not calendar.isleap(year):
+            year += 1
+
+    return datetime.date(year, month, day)
+
+# Bumped when the pickled form of TaskCache entries changes
+CACHE_VERSION = 2
+# Cache entries written between checks of the cache size
+CACHE_PRUNE_INTERVAL = 500
+# Seconds before a hit moves a cache entry up the LRU order again
+CACHE_TOUCH_INTERVAL = 60
+
+# Journal records appended before a task snapshot is rewritten
+JOURNAL_COMPACT_SIZE = 100
+# Times a task is read again when it was compacted during the read
+JOURNAL_READ_ATTEMPTS = 5
+
+# Files the search index terms are spread over
+SEARCH_SHARDS = 64
+# Bumped when the layout of the search index changes, which rebuilds it
+SEARCH_VERSION = 2
+
+# Seconds a client waits for the daemon to take its command, eg. while
+# it serves another client, before running the command itself
+DAEMON_WAIT_TIMEOUT = 1.0
+# Seconds the daemon gives a client to send its command or read the reply
+DAEMON_CLIENT_TIMEOUT = 5.0
+
+# Identify the current version of files without reading them
+def file_stamp(paths):
+    stamp = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            stamp.append(None)
+            continue
+        stamp.append((st.st_ino, st.st_mtime_ns, st.st_size))
+    return tuple(stamp)
 
 class Config:
 
@@ -113,23 +153,30 @@ class Config:
 
 class Comment:
 
-    def __init__(self, content, author):
+    # Many thousands are kept in memory by the daemon, and the time is
+    # only turned into a datetime when displayed
+    __slots__ = ("content", "author", "created")
+
+    def __init__(self, content, author, created=None):
         self.content = content
         self.author = author
-        self.timestamp = datetime.datetime.now()
+        # Seconds since the epoch
+        self.created = time.time() if created is None else created
+
+    @property
+    def timestamp(self):
+        return datetime.datetime.fromtimestamp(self.created)
 
     def to_json(self):
         return {
             "content": self.content,
             "author": self.author,
-            "timestamp": self.timestamp.timestamp(),
+            "timestamp": self.created,
         }
 
     @staticmethod
     def from_json(data):
-        self = Comment(data["content"], data["author"])
-        self.timestamp = datetime.datetime.fromtimestamp(data["timestamp"])
-        return self
+        return Comment(data["content"], data["author"], data["timestamp"])
 
     def __repr__(self):
         return f"comment{{ {self.content}, {self.author}, {self.timestamp} }}"
@@ -139,29 +186,141 @@ class Settings:
     def __init__(self, config):
         self.config = config
         self.editor = os.environ.get('EDITOR', 'nvim')
-
-    def month_filename(self, date):
+        # Threads used to read many task files at once
+        self.workers = int(os.environ.get("TAU_WORKERS", 8))
+        # Loaded objects kept in memory across commands by the daemon.
+        # None disables it for normal one-shot runs.
+        self.memo = None
+        # Active TaskStore transaction, if any
+        self.store = None
+        self._storage = None
+        # TAU_FSYNC=1 makes writes durable across power loss. Directory
+        # syncs are batched up until a TaskStore flush ends.
+        self.fsync = os.environ.get("TAU_FSYNC", "0") != "0"
+        self.sync_dirs = None
+        # PhaseTimer collecting counters for --metrics, or None
+        self.metrics = None
+
+    # Opened on first use so commands forwarded to the daemon never do
+    @property
+    def storage(self):
+        if self._storage is None:
+            self._storage = open_storage(self)
+        return self._storage
+
+    # Find an already loaded object, first in the open transaction then
+    # in the daemon memo. Returns None if it must be read from disk.
+    def lookup(self, key, paths):
+        if self.store is not None and key in self.store.objects:
+            return self.store.objects[key]
+        obj = self.memo_get(key, paths)
+        if obj is not None and self.store is not None:
+            self.store.objects[key] = obj
+        return obj
+
+    def remember(self, key, paths, obj):
+        if self.store is not None:
+            self.store.objects[key] = obj
+        self.memo_put(key, paths, obj)
+
+    # Return a previously loaded object if its files are unchanged
+    def memo_get(self, key, paths):
+        if self.memo is None or key not in self.memo:
+            return None
+        stamp, obj = self.memo[key]
+        if stamp != file_stamp(paths):
+            return None
+        return obj
+
+    def memo_put(self, key, paths, obj):
+        if self.memo is None:
+            return
+        self.memo[key] = (file_stamp(paths), obj)
+
+    def count(self, name, amount=1):
+        if self.metrics is not None:
+            self.metrics.count(name, amount)
+
+    # Start a new --metrics phase within the command
+    def mark(self, name):
+        if self.metrics is not None:
+            self.metrics.mark(name)
+
+    def read_json(self, filename):
+        with open(filename, "rb") as f:
+            data = f.read()
+        if self.metrics is not None:
+            self.metrics.count("files read")
+            self.metrics.count("bytes parsed", len(data))
+        return json.loads(data)
+
+    # Write through a hidden temp file renamed over filename, so neither
+    # readers nor a crash ever see half a file. Returns the temp name
+    # instead when rename is False.
+    def write_file(self, filename, text, rename=True):
+        dirname, basename = os.path.split(filename)
+        temp_filename = os.path.join(dirname,
+                                     f".{basename}.{os.getpid()}.tmp")
+        with open(temp_filename, "w") as f:
+            f.write(text)
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        if not rename:
+            return temp_filename
+        os.replace(temp_filename, filename)
+        self.sync_dir(dirname)
+
+    def sync_dir(self, dirname):
+        if not self.fsync:
+            return
+        if self.sync_dirs is not None:
+            self.sync_dirs.add(dirname)
+            return
+        fd = os.open(dirname, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    # Take a writer lock for the object stored under key. Inside a
+    # TaskStore the lock is kept until everything has been flushed, and
+    # whatever was loaded before taking it is dropped as it may be stale.
+    def hold_lock(self, key, lock):
+        if self.store is None:
+            return lock
+        self.store.hold(key, lock)
+        return contextlib.nullcontext()
+
+    def month_name(self, date):
         month, year = date.month, date.year
         year = str(year)[2:]
         month = f"{month:02d}"
-        filename = f"{month}{year}"
+        return f"{month}{year}"
+
+    def month_filename(self, date):
+        filename = self.month_name(date)
         path = os.path.join(self.config.path, f"month/{filename}")
         return path
 
 class MonthTasks:
 
+    # Written after tasks and before the index when a TaskStore flushes
+    flush_order = 1
+
     def __init__(self, created_at, settings):
         self.created_at = created_at
         self.settings = settings
 
         self.task_tks = []
+        # Short id -> ref_id for every task that is still open
+        self.ids = {}
+        # Min-heap of released ids below next_id, reused first
+        self.free_ids = []
+        self.next_id = 0
 
     def objects(self):
-        tks = []
-        for tk_hash in self.task_tks:
-            tk = TaskInfo.load(tk_hash, self.settings)
-            tks.append(tk)
-        return tks
+        return TaskInfo.load_many(self.task_tks, self.settings)
 
     def add(self, tk_hash):
         self.task_tks.append(tk_hash)
@@ -169,21 +328,99 @@ class MonthTasks:
     def remove(self, tk_hash):
         self.task_tks.remove(tk_hash)
 
+    def lookup_id(self, id):
+        return self.ids.get(id)
+
+    def find_free_id(self):
+        if self.free_ids:
+            return self.free_ids[0]
+        return self.next_id
+
+    def claim_id(self, id, tk_hash):
+        assert id not in self.ids
+        if self.free_ids and self.free_ids[0] == id:
+            heapq.heappop(self.free_ids)
+        elif id >= self.next_id:
+            # Anything skipped over becomes free
+            for free_id in range(self.next_id, id):
+                heapq.heappush(self.free_ids, free_id)
+            self.next_id = id + 1
+        else:
+            # Rare: an id was picked from the middle of the free list
+            self.free_ids.remove(id)
+            heapq.heapify(self.free_ids)
+        self.ids[id] = tk_hash
+
+    # Only while id still belongs to tk_hash, it may have been released
+    # and handed to a new task since the caller read it
+    def release_id(self, id, tk_hash):
+        if self.ids.get(id) != tk_hash:
+            return
+        del self.ids[id]
+        heapq.heappush(self.free_ids, id)
+
+    # Recreate the id map for month files written before it existed
+    def rebuild_ids(self):
+        self.ids = {}
+        for tk in self.settings.storage.records(self.task_tks):
+            if tk.get_state() != "stop":
+                self.ids[tk.id] = tk.ref_id
+        self.free_gaps()
+
+    # Every id below the highest one in use is free unless it is taken
+    def free_gaps(self):
+        self.next_id = max(self.ids, default=-1) + 1
+        # Ascending list is already a valid heap
+        self.free_ids = [i for i in range(self.next_id) if i not in self.ids]
+
+    def filename(self):
+        return self.settings.month_filename(self.created_at)
+
     def save(self):
-        data = {
+        if self.settings.store is not None:
+            self.settings.store.stage(self.filename(), self)
+            return
+        self.write()
+
+    def write(self):
+        storage = self.settings.storage
+        storage.write_month(self)
+        self.settings.memo_put(self.filename(),
+                               storage.month_paths(self.created_at), self)
+
+    def to_json(self):
+        return {
             "created_at": self.created_at.timestamp(),
-            "tasks": self.task_tks
+            "tasks": self.task_tks,
+            "ids": {str(id): tk_hash for id, tk_hash in self.ids.items()},
+            "free_ids": self.free_ids,
+            "next_id": self.next_id,
         }
-        with open(self.settings.month_filename(self.created_at), "w") as f:
-            json.dump(data, f, indent=4)
 
     @staticmethod
-    def load(date, settings):
-        with open(settings.month_filename(date), "r") as f:
-            data = json.load(f)
+    def from_json(data, settings):
         created_at = datetime.datetime.fromtimestamp(data["created_at"])
         self = MonthTasks(created_at, settings)
         self.task_tks = data["tasks"]
+        if "ids" in data:
+            self.ids = {int(id): tk_hash for id, tk_hash in data["ids"].items()}
+            self.free_ids = data["free_ids"]
+            self.next_id = data["next_id"]
+        else:
+            self.rebuild_ids()
+        return self
+
+    # Raises FileNotFoundError if the month does not exist
+    @staticmethod
+    def load(date, settings):
+        filename = settings.month_filename(date)
+        paths = settings.storage.month_paths(date)
+        self = settings.lookup(filename, paths)
+        if self is not None:
+            return self
+
+        self = settings.storage.load_month(date)
+        settings.remember(filename, paths, self)
         return self
 
     @staticmethod
@@ -191,40 +428,95 @@ class MonthTasks:
         try:
             return MonthTasks.load(date, settings)
         except FileNotFoundError:
-            # File does not yet exist. Create a new one
-            month_tks = MonthTasks(date, settings)
-            # TODO: Auto roll over open tasks from month before
-            # Open last month, copy open tasks to this object
-            # Function to return open tasks from last month
-            # Then assign to this month and save.
-            month_tks.save()
-            return month_tks
+            pass
+        # File does not yet exist. Create a new one
+        month_tks = MonthTasks(date, settings)
+        previous = MonthTasks.load_previous(date, settings)
+        if previous is not None:
+            month_tks.roll_over(previous)
+        # Another tau may be creating the same month right now. Only one
+        # of us gets to write it, the other reads what the winner wrote.
+        storage = settings.storage
+        if not storage.create_month(month_tks):
+            return MonthTasks.load(date, settings)
+        settings.remember(month_tks.filename(),
+                          storage.month_paths(date), month_tks)
+        return month_tks
+
+    # Writers hold this around loading, changing and saving a month
+    @staticmethod
+    def lock(date, settings):
+        return settings.hold_lock(settings.month_filename(date),
+                                  settings.storage.lock_month(date))
 
+    # Most recent month before date, or None if there isn't one
+    @staticmethod
+    def load_previous(date, settings):
+        name = settings.month_name(date)
+        # Month names are MMYY so order them by (year, month)
+        earlier = [month for month in settings.storage.month_dates()
+                   if month < date and settings.month_name(month) != name]
+        if not earlier:
+            return None
+        return MonthTasks.load(max(earlier), settings)
+
+    # Carry the open tasks of the previous month over, keeping their ids.
+    # The id map already is the open set so no task is read.
+    def roll_over(self, previous):
+        self.ids = dict(sorted(previous.ids.items()))
+        self.task_tks = list(self.ids.values())
+        self.free_gaps()
+
+# Tasks keep their events as two arrays of action codes and timestamps
+EVENT_ACTIONS = ("open", "start", "pause", "stop")
+EVENT_CODES = {action: code for code, action in enumerate(EVENT_ACTIONS)}
+
+# A view of one event, only built when the history is displayed
 class TaskEvent:
 
-    def __init__(self, action):
+    __slots__ = ("action", "created")
+
+    def __init__(self, action, created=None):
         self.action = action
-        self.timestamp = datetime.datetime.now()
+        # Seconds since the epoch
+        self.created = time.time() if created is None else created
+
+    @property
+    def timestamp(self):
+        return datetime.datetime.fromtimestamp(self.created)
 
     def to_json(self):
         return {
             "action": self.action,
-            "timestamp": self.timestamp.timestamp(),
+            "timestamp": self.created,
         }
 
     @staticmethod
     def from_json(data):
-        self = TaskEvent(data["action"])
-        self.timestamp = datetime.datetime.fromtimestamp(data["timestamp"])
-        return self
+        return TaskEvent(data["action"], data["timestamp"])
 
     def __repr__(self):
         return f"event{{ {self.action}, {self.timestamp} }}"
 
 class TaskInfo:
 
+    flush_order = 0
+
+    # Fields are kept the way they are stored: due as DDMMYY, rank as a
+    # decimal string and created_at as a float. The properties below
+    # decode them when used.
+    __slots__ = (
+        "ref_id", "id", "title", "desc", "assign", "project",
+        "_due", "_rank", "_created_at",
+        "event_actions", "event_times", "comments",
+        "settings", "pending", "journal_len", "journal_gen", "saved",
+        "needs_snapshot",
+    )
+
     def __init__(self, ref_id, id, title, desc, assign, project, due,
                  rank, created_at, settings):
+        import array
+
         self.ref_id = ref_id
         self.id = id
         self.title = title
@@ -236,96 +528,253 @@ class TaskInfo:
         self.rank = rank
         self.created_at = created_at
 
-        self.events = []
+        # Event history as parallel arrays: EVENT_ACTIONS codes and times
+        self.event_actions = array.array("B")
+        self.event_times = array.array("d")
         self.comments = []
 
         self.settings = settings
 
+        # Events and comments not yet written to disk
+        self.pending = []
+        # Number of records in the journal file after the snapshot
+        self.journal_len = 0
+        # Bumped whenever the snapshot takes the journal in, see
+        # JsonStorage.write_snapshot()
+        self.journal_gen = 0
+        # Whether this task exists in storage
+        self.saved = False
+        # Header changed, so the next write must rewrite the snapshot
+        self.needs_snapshot = False
+
+    @property
+    def due(self):
+        if self._due is None:
+            return None
+        return datetime.datetime.strptime(self._due, "%d%m%y").date()
+
+    @due.setter
+    def due(self, due):
+        self._due = None if due is None else due.strftime("%d%m%y")
+
+    @property
+    def rank(self):
+        if self._rank is None:
+            return None
+        return Real(self._rank)
+
+    @rank.setter
+    def rank(self, rank):
+        self._rank = None if rank is None else str(rank)
+
+    @property
+    def created_at(self):
+        return datetime.datetime.fromtimestamp(self._created_at)
+
+    @created_at.setter
+    def created_at(self, created_at):
+        self._created_at = created_at.timestamp()
+
+    # Fresh TaskEvent views, changes go through set_state()
+    @property
+    def events(self):
+        return [TaskEvent(EVENT_ACTIONS[code], created) for code, created
+                in zip(self.event_actions, self.event_times)]
+
+    def add_event(self, action, created):
+        self.event_actions.append(EVENT_CODES[action])
+        self.event_times.append(created)
+
     def set_state(self, action):
         # Do nothing if this state is already active
         if self.get_state() == action:
             return
         event = TaskEvent(action)
-        self.events.append(event)
+        self.add_event(event.action, event.created)
+        self.pending.append({"type": "event", **event.to_json()})
 
     def set_comment(self, comment, author):
         comment = Comment(comment, author)
         self.comments.append(comment)
+        self.pending.append({"type": "comment", **comment.to_json()})
 
     def get_state(self):
-        if not self.events:
+        if not self.event_actions:
             return "open"
-        return self.events[-1].action
+        return EVENT_ACTIONS[self.event_actions[-1]]
 
-    def activate(self):
-        # Open the task
-        month_tks = MonthTasks.load_or_create(self.created_at, self.settings)
-        month_tks.add(self.tk_hash())
-        month_tks.save()    
+    # Add an event or comment record written to the journal
+    def replay(self, record):
+        if record["type"] == "event":
+            self.add_event(record["action"], record["timestamp"])
+        elif record["type"] == "comment":
+            self.comments.append(Comment.from_json(record))
 
-    @staticmethod
-    def data_path(settings, tk_hash):
-        path = os.path.join(settings.config.path,
-                            f"task/{tk_hash}")
-        return path
+    def events_json(self):
+        return [{"action": EVENT_ACTIONS[code], "timestamp": created}
+                for code, created
+                in zip(self.event_actions, self.event_times)]
 
-    def path(self):
-        return TaskInfo.data_path(self.settings, self.tk_hash())
+    def comments_json(self):
+        return [comment.to_json() for comment in self.comments]
 
-    def save(self):
-        if self.due is None:
-            due = None
-        else:
-            due = self.due.strftime("%d%m%y")
+    # Writers hold this from loading a task until it has been saved, so
+    # no change made in between is lost.
+    #
+    # Months are always locked before tasks. A TaskStore keeps its locks
+    # until it is flushed, so a later operation could need the month after
+    # an earlier one locked a task. The store takes this month's lock up
+    # front instead.
+    @staticmethod
+    def lock(tk_hash, settings):
+        if settings.store is not None:
+            MonthTasks.lock(datetime.datetime.now(), settings)
+        return settings.hold_lock(tk_hash,
+                                  settings.storage.lock_task(tk_hash))
 
-        if self.rank is None:
-            rank = None
-        else:
-            rank = str(self.rank)
+    def activate(self):
+        # Open the task
+        with MonthTasks.lock(self.created_at, self.settings), \
+                TaskInfo.lock(self.tk_hash(), self.settings):
+            month_tks = MonthTasks.load_or_create(self.created_at,
+                                                  self.settings)
+            if self.id in month_tks.ids:
+                # Our short id was taken in the meantime, pick a free one
+                self.id = month_tks.find_free_id()
+                self.save(compact=True)
+            month_tks.add(self.tk_hash())
+            month_tks.claim_id(self.id, self.tk_hash())
+            month_tks.save()
 
-        data = {
+    # Only new events and comments are written, unless this is a new task
+    # or the header changed (compact=True).
+    def save(self, compact=False):
+        if compact:
+            self.needs_snapshot = True
+        if self.settings.store is not None:
+            self.settings.store.stage(self.tk_hash(), self)
+            return
+        self.write()
+
+    def write(self):
+        # Text only changes for new tasks, header edits and comments
+        header_changed = not self.saved or self.needs_snapshot
+        text_changed = (header_changed or
+                        any(record["type"] == "comment"
+                            for record in self.pending))
+
+        # New tasks are counted in full, otherwise only the new events
+        if self.saved:
+            events = [record for record in self.pending
+                      if record["type"] == "event"]
+        else:
+            events = None
+
+        storage = self.settings.storage
+        storage.write_task(self)
+        self.settings.memo_put(self.tk_hash(),
+                               storage.task_paths(self.tk_hash()), self)
+
+        if events is None or events:
+            stats = StatsIndex.for_task(self.ref_id, self.settings)
+            stats.update(self, events)
+            stats.save()
+
+        # Ranks and due dates change with the header, and stopping drops
+        # the task. Other events leave them alone.
+        if header_changed or any(event["action"] == "stop"
+                                 for event in events):
+            for index_class in (RankIndex, DueIndex):
+                index = index_class.load(self.settings)
+                if index.update(self):
+                    index.save()
+
+        if text_changed:
+            filename = SearchIndex.meta_filename(self.settings)
+            with self.settings.hold_lock(filename, SearchIndex.lock(filename)):
+                search_index = SearchIndex.load(self.settings)
+                if search_index.complete and search_index.update(self):
+                    search_index.save()
+
+    # Everything except the events and comments
+    def header_json(self):
+        return {
             "id": self.id,
             "title": self.title,
             "desc": self.desc,
             "assign": self.assign,
             "project": self.project,
-            "due": due,
-            "rank": rank,
-            "created_at": self.created_at.timestamp(),
-            "events": [event.to_json() for event in self.events],
-            "comments": [comment.to_json() for comment in self.comments],
+            "due": self._due,
+            "rank": self._rank,
+            "created_at": self._created_at,
+            # Cached so readers don't need to look at the events
+            "state": self.get_state(),
         }
-        with open(self.path(), "w") as f:
-            json.dump(data, f, indent=4)
 
+    # Build a task from its header and the stored events and comments.
+    # Fields are copied as they are, nothing is decoded.
     @staticmethod
-    def load(tk_hash, settings):
-        path = TaskInfo.data_path(settings, tk_hash)
-        with open(path, "r") as f:
-            data = json.load(f)
-
-        if data["due"] is None:
-            due = None
-        else:
-            due = datetime.datetime.strptime(data["due"], "%d%m%y").date()
-
-        created_at = datetime.datetime.fromtimestamp(data["created_at"])
-
-        if data["rank"] is None:
-            rank = None
-        else:
-            rank = Real(data["rank"])
-
+    def from_header_json(tk_hash, data, settings, raw_events, raw_comments):
         tk = TaskInfo(
             tk_hash, data["id"], data["title"], data["desc"],
-            data["assign"], data["project"], due, rank,
-            created_at, settings)
-        for event_data in data["events"]:
-            tk.events.append(TaskEvent.from_json(event_data))
-        for comment_data in data["comments"]:
-            tk.comments.append(Comment.from_json(comment_data))
+            data["assign"], data["project"], None, None,
+            datetime.datetime.now(), settings)
+        tk._due = data["due"]
+        tk._rank = data["rank"]
+        tk._created_at = data["created_at"]
+        for event in raw_events:
+            tk.add_event(event["action"], event["timestamp"])
+        tk.comments = [Comment.from_json(comment) for comment in raw_comments]
+        tk.saved = True
         return tk
+
+    @staticmethod
+    def load(tk_hash, settings):
+        paths = settings.storage.task_paths(tk_hash)
+        tk = settings.lookup(tk_hash, paths)
+        if tk is not None:
+            return tk
+
+        tk = settings.storage.load_task(tk_hash)
+        settings.count("tasks loaded")
+        settings.remember(tk_hash, paths, tk)
+        return tk
+
+    # Same as calling load() for each, but lets the storage read the
+    # tasks which aren't already in memory concurrently.
+    # Results are in the same order as tk_hashes.
+    @staticmethod
+    def load_many(tk_hashes, settings):
+        storage = settings.storage
+        tks = {}
+        missing = []
+        for tk_hash in tk_hashes:
+            tk = settings.lookup(tk_hash, storage.task_paths(tk_hash))
+            if tk is None:
+                missing.append(tk_hash)
+            else:
+                tks[tk_hash] = tk
+
+        settings.count("tasks loaded", len(missing))
+        for tk in storage.load_tasks(missing):
+            tk_hash = tk.tk_hash()
+            settings.remember(tk_hash, storage.task_paths(tk_hash), tk)
+            tks[tk_hash] = tk
+
+        return [tks[tk_hash] for tk_hash in tk_hashes]
     
+    # Pickled by TaskCache without the settings, which are reattached
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in TaskInfo.__slots__
+                if name != "settings"}
+
+    def __setstate__(self, state):
+        self.settings = None
+        # Entries pickled before the field existed
+        self.journal_gen = 0
+        for name, value in state.items():
+            setattr(self, name, value)
+
     def tk_hash(self):
         # TODO: replace tk_hash with ref_id
         # TODO: come up with proper naming/distinction between id and ref_id
@@ -356,7 +805,1750 @@ class TaskInfo:
         )
         return result
 
+# Compact summary of a task, enough to list it without opening its file
+class TaskRecord:
+
+    __slots__ = ("ref_id", "id", "title", "project", "assign", "due",
+                 "rank", "state", "created_at")
+
+    def __init__(self, ref_id, id, title, project, assign, due, rank,
+                 state, created_at):
+        self.ref_id = ref_id
+        self.id = id
+        self.title = title
+        self.project = project
+        self.assign = assign
+        self.due = due
+        self.rank = rank
+        self.state = state
+        self.created_at = created_at
+
+    @staticmethod
+    def from_task(tk):
+        return TaskRecord(
+            tk.ref_id, tk.id, tk.title, tk.project, tk.assign, tk.due,
+            tk.rank, tk.get_state(), tk.created_at)
+
+    def get_state(self):
+        return self.state
+
+    def to_json(self):
+        if self.due is None:
+            due = None
+        else:
+            due = self.due.strftime("%d%m%y")
+
+        if self.rank is None:
+            rank = None
+        else:
+            rank = str(self.rank)
+
+        return {
+            "id": self.id,
+            "title": self.title,
+            "project": self.project,
+            "assign": self.assign,
+            "due": due,
+            "rank": rank,
+            "state": self.state,
+            "created_at": self.created_at.timestamp(),
+        }
+
+    @staticmethod
+    def from_json(ref_id, data):
+        if data["due"] is None:
+            due = None
+        else:
+            due = datetime.datetime.strptime(data["due"], "%d%m%y").date()
+
+        if data["rank"] is None:
+            rank = None
+        else:
+            rank = Real(data["rank"])
+
+        created_at = datetime.datetime.fromtimestamp(data["created_at"])
+        return TaskRecord(
+            ref_id, data["id"], data["title"], data["project"],
+            data["assign"], due, rank, data["state"], created_at)
+
+    def __repr__(self):
+        return f"record{{ {self.id}, {self.ref_id}, {self.state} }}"
+
+# Dotted project paths as a tree: df -> df.net, df.token, ...
+# Each node is {"tasks": [ref_id, ...], "children": {name: node}}.
+class ProjectTrie:
+
+    def __init__(self, root=None):
+        if root is None:
+            root = ProjectTrie.new_node()
+        self.root = root
+
+    @staticmethod
+    def new_node():
+        return {"tasks": [], "children": {}}
+
+    def add(self, project, tk_hash):
+        node = self.root
+        for name in project.split("."):
+            node = node["children"].setdefault(name, ProjectTrie.new_node())
+        node["tasks"].append(tk_hash)
+
+    def remove(self, project, tk_hash):
+        path = [self.root]
+        for name in project.split("."):
+            path.append(path[-1]["children"][name])
+        path[-1]["tasks"].remove(tk_hash)
+        # Drop nodes left empty
+        for name, node, parent in zip(reversed(project.split(".")),
+                                      reversed(path[1:]), reversed(path[:-1])):
+            if node["tasks"] or node["children"]:
+                break
+            del parent["children"][name]
+
+    def nodes(self, node):
+        yield node
+        for child in node["children"].values():
+            yield from self.nodes(child)
+
+    # Every task whose project starts with prefix, the same as
+    # project.startswith(prefix). All components but the last must match
+    # exactly and the last one is matched as a prefix.
+    def match(self, prefix):
+        names = prefix.split(".")
+        node = self.root
+        for name in names[:-1]:
+            node = node["children"].get(name)
+            if node is None:
+                return set()
+
+        tk_hashes = set()
+        for name, child in node["children"].items():
+            if name.startswith(names[-1]):
+                for subnode in self.nodes(child):
+                    tk_hashes.update(subnode["tasks"])
+        return tk_hashes
+
+# An index kept in one JSON file which every tau updates. Another tau may
+# write the file between our load and save, so rather than holding the
+# lock all that time, write() merges the entries we changed into the
+# latest file while holding it for the write only. Subclasses give:
+#
+#   name            the file under the config directory
+#   make_entry(tk)  what the index keeps for a task
+#   encode()        the file contents, read back by decode(data)
+#
+# and override put() when they keep more than data. An index too big to
+# rewrite on every change can be split into files under name/ by giving
+# shard_name(), each file merged on its own.
+class MergedIndex:
+
+    # Written last, once every task and month has updated it
+    flush_order = 2
+
+    def __init__(self, settings, shard=None):
+        self.settings = settings
+        self.shard = shard
+        # ref_id -> entry
+        self.data = {}
+        # Stamp of the file this was read from, and entries changed since
+        self.stamp = None
+        self.changed = set()
+
+    # Shard holding the entry of a task, None when there is one file
+    @staticmethod
+    def shard_name(tk_hash):
+        return None
+
+    @classmethod
+    def filename(cls, settings, shard=None):
+        if shard is None:
+            return os.path.join(settings.config.path, cls.name)
+        return os.path.join(settings.config.path, cls.name, shard)
+
+    def put(self, tk_hash, entry):
+        self.data[tk_hash] = entry
+
+    # Returns True if anything changed
+    def update(self, tk):
+        entry = self.make_entry(tk)
+        if tk.ref_id in self.data and self.data[tk.ref_id] == entry:
+            return False
+        self.put(tk.ref_id, entry)
+        self.changed.add(tk.ref_id)
+        return True
+
+    # Add entries for any tasks missing from the index, eg. from before
+    # it existed. Returns True when the index was modified.
+    def sync(self, tk_hashes):
+        missing = [tk_hash for tk_hash in tk_hashes
+                   if tk_hash not in self.data]
+        for tk in TaskInfo.load_many(missing, self.settings):
+            self.update(tk)
+        return bool(missing)
+
+    def save(self):
+        if self.settings.store is not None:
+            self.settings.store.stage(
+                self.filename(self.settings, self.shard), self)
+            return
+        self.write()
+
+    def write(self):
+        filename = self.filename(self.settings, self.shard)
+        if self.shard is not None:
+            make_path(os.path.dirname(filename))
+        with file_lock(filename):
+            if file_stamp([filename]) != self.stamp:
+                latest = self.read(self.settings, self.shard)
+                for tk_hash in self.changed:
+                    latest.put(tk_hash, self.data[tk_hash])
+                vars(self).update(vars(latest))
+            self.settings.write_file(filename, json.dumps(self.encode()))
+            self.stamp = file_stamp([filename])
+        self.changed = set()
+        self.settings.memo_put(filename, [filename], self)
+
+    @classmethod
+    def load(cls, settings, shard=None):
+        filename = cls.filename(settings, shard)
+        self = settings.lookup(filename, [filename])
+        if self is not None:
+            return self
+
+        self = cls.read(settings, shard)
+        settings.remember(filename, [filename], self)
+        return self
+
+    @classmethod
+    def read(cls, settings, shard=None):
+        filename = cls.filename(settings, shard)
+        self = cls(settings, shard)
+        self.stamp = file_stamp([filename])
+        try:
+            data = settings.read_json(filename)
+        except FileNotFoundError:
+            return self
+        self.decode(data)
+        return self
+
+    # Shards written so far
+    @classmethod
+    def shard_names(cls, settings):
+        return [None]
+
+    # The index, or the shard of it, holding the entry of a task
+    @classmethod
+    def for_task(cls, tk_hash, settings):
+        return cls.load(settings, cls.shard_name(tk_hash))
+
+    # ref_id -> entry for every task in tk_hashes, adding those missing.
+    # shards keeps what was loaded, for callers reading in several goes.
+    @classmethod
+    def entries(cls, tk_hashes, settings, shards=None):
+        if shards is None:
+            shards = {}
+        groups = {}
+        for tk_hash in tk_hashes:
+            groups.setdefault(cls.shard_name(tk_hash), []).append(tk_hash)
+        entries = {}
+        for shard, shard_hashes in groups.items():
+            if shard not in shards:
+                shards[shard] = cls.load(settings, shard)
+            self = shards[shard]
+            if self.sync(shard_hashes):
+                self.save()
+            for tk_hash in shard_hashes:
+                entries[tk_hash] = self.data[tk_hash]
+        return entries
+
+    # Throw away the index and scan every file in task/. Returns the
+    # number of tasks indexed.
+    @classmethod
+    def rebuild(cls, settings):
+        shards = {}
+        def start(shard):
+            self = cls(settings, shard)
+            # Replaces whatever is there instead of merging into it
+            self.stamp = file_stamp([cls.filename(settings, shard)])
+            shards[shard] = self
+            return self
+
+        # Including those no task is left in
+        for shard in cls.shard_names(settings):
+            start(shard)
+        tk_hashes = settings.storage.task_hashes()
+        for tk in TaskInfo.load_many(tk_hashes, settings):
+            shard = cls.shard_name(tk.ref_id)
+            self = shards.get(shard) or start(shard)
+            self.update(tk)
+        for self in shards.values():
+            self.save()
+        return len(tk_hashes)
+
+# A MergedIndex split into name/00 to name/ff by ref_id prefix, so a
+# change to one task only rewrites the entries of the tasks sharing it
+class ShardedIndex(MergedIndex):
+
+    @staticmethod
+    def shard_name(tk_hash):
+        return tk_hash[:2]
+
+    @classmethod
+    def shard_names(cls, settings):
+        try:
+            names = os.listdir(cls.filename(settings))
+        except FileNotFoundError:
+            return []
+        return [name for name in names if not name.startswith(".")]
+
+# A TaskRecord for every task in the task/ directory, plus a ProjectTrie
+# of them, per shard.
+# Kept up to date by JsonStorage whenever tasks are written.
+class TaskIndex(ShardedIndex):
+
+    name = "records"
+
+    def __init__(self, settings, shard=None):
+        super().__init__(settings, shard)
+        self.projects = ProjectTrie()
+
+    # Kept as JSON, records are only decoded when looked up
+    def make_entry(self, tk):
+        return TaskRecord.from_task(tk).to_json()
+
+    def put(self, tk_hash, record):
+        old = self.data.get(tk_hash)
+        old_project = None if old is None else old["project"]
+        if old is None or old_project != record["project"]:
+            if old_project is not None:
+                self.projects.remove(old_project, tk_hash)
+            if record["project"] is not None:
+                self.projects.add(record["project"], tk_hash)
+        self.data[tk_hash] = record
+
+    # Tasks from tk_hashes which aren't stopped and match the project
+    # prefix, if any. Only the records returned get decoded.
+    @staticmethod
+    def open_records(tk_hashes, settings, project_prefix=None):
+        shards = {}
+        entries = TaskIndex.entries(tk_hashes, settings, shards)
+        if project_prefix is not None:
+            matching = set()
+            for self in shards.values():
+                matching.update(self.projects.match(project_prefix))
+            tk_hashes = [tk_hash for tk_hash in tk_hashes
+                         if tk_hash in matching]
+        return [TaskRecord.from_json(tk_hash, entries[tk_hash])
+                for tk_hash in tk_hashes
+                if entries[tk_hash]["state"] != "stop"]
+
+    # (project, state) of every open task in tk_hashes with a project
+    @staticmethod
+    def project_states(tk_hashes, settings):
+        entries = TaskIndex.entries(tk_hashes, settings)
+        states = []
+        for tk_hash in tk_hashes:
+            data = entries[tk_hash]
+            if data["project"] is not None and data["state"] != "stop":
+                states.append((data["project"], data["state"]))
+        return states
+
+    # Fetch records in the same order as tk_hashes
+    @staticmethod
+    def records(tk_hashes, settings, shards=None):
+        entries = TaskIndex.entries(tk_hashes, settings, shards)
+        return [TaskRecord.from_json(tk_hash, entries[tk_hash])
+                for tk_hash in tk_hashes]
+
+    def encode(self):
+        return {"tasks": self.data, "projects": self.projects.root}
+
+    def decode(self, data):
+        self.data = data["tasks"]
+        self.projects = ProjectTrie(data["projects"])
+
+# Split text into lowercase search terms
+def tokenize(text):
+    import re
+    return [term for term in re.findall(r"\w+", text.lower())
+            if len(term) > 1]
+
+# Term -> count for a task. Title words count extra.
+def task_terms(tk):
+    terms = {}
+    def add(text, weight):
+        if text is None:
+            return
+        for term in tokenize(text):
+            terms[term] = terms.get(term, 0) + weight
+    add(tk.title, 3)
+    add(tk.desc, 1)
+    for comment in tk.comments_json():
+        add(comment["content"], 1)
+    return terms
+
+# Inverted index over task titles, descriptions and comments for every
+# task in every month. Lives under search/:
+#
+#   shard-NN     term -> {ref_id: count}, terms spread over SEARCH_SHARDS
+#   docs-XX      ref_id -> the terms last indexed for the task, to find
+#                stale postings. Split by the first two ref_id digits.
+#   meta         number of tasks indexed and the layout version
+#
+# A query only reads the shards of its terms, and updating a task only
+# rewrites its docs file and the shards of terms that changed. Every
+# task is indexed when it is saved, so an index with a meta file of the
+# current version is complete. One without is rebuilt by the next
+# search; until then saves leave it alone.
+class SearchIndex:
+
+    flush_order = 2
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.path = os.path.join(settings.config.path, "search")
+        self.doc_count = 0
+        # Whether the index on disk covers every task
+        self.complete = False
+        # Shard number -> {term: {ref_id: count}}, loaded on demand
+        self.shards = {}
+        self.dirty_shards = set()
+        # Docs shard name -> {ref_id: terms}, loaded on demand
+        self.docs = {}
+        self.dirty_docs = set()
+
+    @staticmethod
+    def meta_filename(settings):
+        return os.path.join(settings.config.path, "search", "meta")
+
+    # Shards are updated in place, so writers hold the meta lock from
+    # loading the index until it has been saved
+    @staticmethod
+    def lock(filename):
+        make_path(os.path.dirname(filename))
+        return file_lock(filename)
+
+    @staticmethod
+    def shard_number(term):
+        import zlib
+        return zlib.crc32(term.encode()) % SEARCH_SHARDS
+
+    def shard_filename(self, number):
+        return os.path.join(self.path, f"shard-{number:02d}")
+
+    def docs_filename(self, name):
+        return os.path.join(self.path, f"docs-{name}")
+
+    def shard(self, number):
+        if number not in self.shards:
+            try:
+                self.shards[number] = self.settings.read_json(
+                    self.shard_filename(number))
+            except FileNotFoundError:
+                self.shards[number] = {}
+        return self.shards[number]
+
+    def docs_shard(self, name):
+        if name not in self.docs:
+            try:
+                self.docs[name] = self.settings.read_json(
+                    self.docs_filename(name))
+            except FileNotFoundError:
+                self.docs[name] = {}
+        return self.docs[name]
+
+    # Returns True if anything changed
+    def update(self, tk):
+        tk_hash = tk.tk_hash()
+        terms = task_terms(tk)
+        docs = self.docs_shard(tk_hash[:2])
+        old_terms = docs.get(tk_hash)
+        if old_terms is None:
+            self.doc_count += 1
+            old_terms = {}
+        elif old_terms == terms:
+            return False
+
+        for term in old_terms.keys() | terms.keys():
+            count = terms.get(term)
+            if old_terms.get(term) == count:
+                continue
+            number = SearchIndex.shard_number(term)
+            shard = self.shard(number)
+            postings = shard.setdefault(term, {})
+            if count is None:
+                del postings[tk_hash]
+                if not postings:
+                    del shard[term]
+            else:
+                postings[tk_hash] = count
+            self.dirty_shards.add(number)
+
+        docs[tk_hash] = terms
+        self.dirty_docs.add(tk_hash[:2])
+        return True
+
+    # Best matches first as (score, ref_id)
+    def search(self, query, limit):
+        import math
+
+        scores = {}
+        for term in set(tokenize(query)):
+            postings = self.shard(SearchIndex.shard_number(term)).get(term)
+            if not postings:
+                continue
+            # Rare terms count for more
+            idf = math.log(1 + max(self.doc_count, 1) / len(postings))
+            for tk_hash, count in postings.items():
+                score = (1 + math.log(count)) * idf
+                scores[tk_hash] = scores.get(tk_hash, 0) + score
+
+        return heapq.nlargest(limit, ((score, tk_hash)
+                                      for tk_hash, score in scores.items()))
+
+    def save(self):
+        if self.settings.store is not None:
+            self.settings.store.stage(SearchIndex.meta_filename(self.settings),
+                                      self)
+            return
+        self.write()
+
+    def write(self):
+        make_path(self.path)
+        for name in self.dirty_docs:
+            self.settings.write_file(self.docs_filename(name),
+                                     json.dumps(self.docs[name]))
+        for number in self.dirty_shards:
+            self.settings.write_file(self.shard_filename(number),
+                                     json.dumps(self.shards[number]))
+        self.dirty_docs = set()
+        self.dirty_shards = set()
+
+        # Written last on every change, so its stamp versions the index
+        filename = SearchIndex.meta_filename(self.settings)
+        self.settings.write_file(filename, json.dumps({
+            "docs": self.doc_count,
+            "version": SEARCH_VERSION,
+        }))
+        self.complete = True
+        self.settings.memo_put(filename, [filename], self)
+
+    @staticmethod
+    def load(settings):
+        filename = SearchIndex.meta_filename(settings)
+        self = settings.lookup(filename, [filename])
+        if self is not None:
+            return self
+
+        self = SearchIndex(settings)
+        try:
+            data = settings.read_json(filename)
+        except FileNotFoundError:
+            pass
+        else:
+            # Older layouts are left to be rebuilt
+            if data.get("version") == SEARCH_VERSION:
+                self.doc_count = data["docs"]
+                self.complete = True
+        settings.remember(filename, [filename], self)
+        return self
+
+    # Index every task from scratch. The caller holds the meta lock.
+    @staticmethod
+    def build(settings):
+        import shutil
+        self = SearchIndex(settings)
+        # Keep the lock file, it is what other writers wait on
+        for entry in os.scandir(self.path):
+            if entry.is_dir():
+                shutil.rmtree(entry.path, ignore_errors=True)
+            elif not entry.name.endswith(".lock"):
+                os.remove(entry.path)
+        tk_hashes = settings.storage.task_hashes()
+        for tk in TaskInfo.load_many(tk_hashes, settings):
+            self.update(tk)
+        self.save()
+        return self
+
+    @staticmethod
+    def rebuild(settings):
+        filename = SearchIndex.meta_filename(settings)
+        with settings.hold_lock(filename, SearchIndex.lock(filename)):
+            return SearchIndex.build(settings)
+
+# Time tracking totals for every task, kept up to date from the events
+# saved so that tau stats never replays whole histories. Per task:
+#
+#   created   when the task was made
+#   stopped   time of its last stop event, or None
+#   running   time of the start event still in progress, or None
+#   active    month name -> seconds worked in finished start intervals
+#   spans     [start, end] times of the finished start intervals
+class StatsIndex(ShardedIndex):
+
+    name = "totals"
+
+    # Apply new event records to the totals, or recount every event of
+    # the task when there is nothing to build on
+    def update(self, tk, events=None):
+        entry = self.data.get(tk.ref_id)
+        if entry is None or events is None or "spans" not in entry:
+            entry = {"created": tk._created_at, "stopped": None,
+                     "running": None, "active": {}, "spans": []}
+            events = tk.events_json()
+        for event in events:
+            self.add_event(entry, event["action"], event["timestamp"])
+        self.data[tk.ref_id] = entry
+        self.changed.add(tk.ref_id)
+
+    def add_event(self, entry, action, timestamp):
+        if entry["running"] is not None:
+            active = entry["active"]
+            for name, seconds in month_spans(entry["running"], timestamp,
+                                             self.settings):
+                active[name] = active.get(name, 0) + seconds
+            entry["spans"].append([entry["running"], timestamp])
+        entry["running"] = timestamp if action == "start" else None
+        entry["stopped"] = timestamp if action == "stop" else None
+
+    # Tasks missing, or counted before spans were kept, are counted again
+    def sync(self, tk_hashes):
+        stale = [tk_hash for tk_hash in tk_hashes
+                 if "spans" not in self.data.get(tk_hash, {})]
+        for tk in TaskInfo.load_many(stale, self.settings):
+            self.update(tk)
+        return bool(stale)
+
+    # Seconds the task was started for in the given months, counting a
+    # start still in progress up to now or the end of the range
+    @staticmethod
+    def active_time(entry, month_names, range_end, now, settings):
+        active = entry["active"]
+        seconds = sum(active.get(name, 0) for name in month_names)
+        if entry["running"] is not None:
+            end = min(now, range_end)
+            for name, span in month_spans(entry["running"], end, settings):
+                if name in month_names:
+                    seconds += span
+        return seconds
+
+    def encode(self):
+        return self.data
+
+    def decode(self, data):
+        self.data = data
+
+# A MergedIndex also kept sorted by a key of its entries, so ranges of
+# keys are found by bisection. Entries of None have no key and are left
+# out of the order, so tasks without one can still be told apart from
+# tasks missing altogether and synced.
+class SortedIndex(MergedIndex):
+
+    def __init__(self, settings, shard=None):
+        super().__init__(settings, shard)
+        # Ascending keys and the ref_id at the same position
+        self.keys = []
+        self.hashes = []
+
+    def key(self, entry):
+        return entry
+
+    def put(self, tk_hash, entry):
+        old = self.data.get(tk_hash)
+        if old is not None:
+            i = bisect.bisect_left(self.keys, self.key(old))
+            while self.hashes[i] != tk_hash:
+                i += 1
+            del self.keys[i]
+            del self.hashes[i]
+        if entry is not None:
+            key = self.key(entry)
+            i = bisect.bisect_right(self.keys, key)
+            self.keys.insert(i, key)
+            self.hashes.insert(i, tk_hash)
+        self.data[tk_hash] = entry
+
+    # (ref_id, entry) in key order, and the ref_ids of None entries
+    def sorted_entries(self):
+        return ([(tk_hash, self.data[tk_hash]) for tk_hash in self.hashes],
+                [tk_hash for tk_hash, entry in self.data.items()
+                 if entry is None])
+
+    # Read back what sorted_entries() gave, which is already in order
+    def extend(self, entries, keyless):
+        for tk_hash, entry in entries:
+            self.keys.append(self.key(entry))
+            self.hashes.append(tk_hash)
+            self.data[tk_hash] = entry
+        self.data.update(dict.fromkeys(keyless))
+
+# Ranks of the tasks which aren't stopped, so tau rank finds the
+# neighbours of a task by bisection. Stopped and unranked tasks have
+# no rank.
+class RankIndex(SortedIndex):
+
+    name = "ranks"
+
+    def make_entry(self, tk):
+        return None if tk.get_state() == "stop" else tk.rank
+
+    # Positions of the entries either side of the gap just above or below
+    # rank, stepping over the task being moved. Either may be off the end.
+    def gap(self, rank, above, tk_hash):
+        if above:
+            upper = bisect.bisect_right(self.keys, rank)
+        else:
+            upper = bisect.bisect_left(self.keys, rank)
+        lower = upper - 1
+        while lower >= 0 and self.hashes[lower] == tk_hash:
+            lower -= 1
+        while upper < len(self.keys) and self.hashes[upper] == tk_hash:
+            upper += 1
+        return lower, upper
+
+    # New ranks putting tk_hash into the gap between lower and upper,
+    # as {ref_id: rank}. Only when the gap is too narrow are the closest
+    # neighbours spread out too, taking in more of them until they fit.
+    def place(self, tk_hash, lower, upper):
+        width = 0
+        while True:
+            low_i, high_i = lower - width, upper + width
+            low = self.keys[low_i] if low_i >= 0 else None
+            high = self.keys[high_i] if high_i < len(self.keys) else None
+            order = [h for h in self.hashes[max(low_i + 1, 0):lower + 1]
+                     if h != tk_hash]
+            order.append(tk_hash)
+            order += [h for h in self.hashes[upper:max(high_i, upper)]
+                      if h != tk_hash]
+            ranks = spread_ranks(low, high, len(order))
+            if ranks is not None:
+                return dict(zip(order, ranks))
+            width = max(1, width * 2)
+
+    def encode(self):
+        entries, unranked = self.sorted_entries()
+        return {"ranks": [[str(rank), tk_hash] for tk_hash, rank in entries],
+                "unranked": unranked}
+
+    def decode(self, data):
+        self.extend([(tk_hash, Real(rank)) for rank, tk_hash in data["ranks"]],
+                     data["unranked"])
+
+# Decimal places tau rank may use before it spreads out neighbours
+RANK_PLACES = 4
+
+# count ascending ranks evenly spaced strictly between low and high,
+# rounded to as few decimal places as keep them apart. A missing high
+# bound leaves whole numbers of room above. A missing low bound spreads
+# down towards 0 rather than past it, so the ranks stay above unranked
+# tasks. None if RANK_PLACES are not enough.
+def spread_ranks(low, high, count):
+    from decimal import ROUND_CEILING, ROUND_FLOOR
+    if low is None and high is None:
+        low = Real(0)
+    if high is None:
+        high = low.to_integral_value(ROUND_FLOOR) + count + 1
+    if low is None:
+        if high > 0:
+            low = Real(0)
+        else:
+            # Only ranks given below 0 by hand leave no room above it
+            low = high.to_integral_value(ROUND_CEILING) - count - 1
+
+    step = (high - low) / (count + 1)
+    for places in range(RANK_PLACES + 1):
+        exponent = Real(1).scaleb(-places)
+        ranks = [(low + step * (n + 1)).quantize(exponent)
+                 for n in range(count)]
+        bounds = [low] + ranks + [high]
+        if all(a < b for a, b in zip(bounds, bounds[1:])):
+            return ranks
+    return None
+
+# Due dates of the tasks which aren't stopped, across every month, as
+# ISO dates so tau due looks up date ranges by bisection. The assignee
+# is kept alongside, so tau due --summary reads nothing else.
+class DueIndex(SortedIndex):
+
+    name = "due"
+
+    # [due, assign], or None for tasks without a due date
+    def make_entry(self, tk):
+        if tk.get_state() == "stop" or tk.due is None:
+            return None
+        return [tk.due.isoformat(), tk.assign]
+
+    def key(self, entry):
+        return entry[0]
+
+    # ref_ids due from start up to but not including end, soonest first.
+    # Both are dates, start None for everything before end.
+    def due_between(self, start, end, assign=None):
+        if start is None:
+            low = 0
+        else:
+            low = bisect.bisect_left(self.keys, start.isoformat())
+        high = bisect.bisect_left(self.keys, end.isoformat())
+        return [tk_hash for tk_hash in self.hashes[low:high]
+                if assign is None or self.data[tk_hash][1] == assign]
+
+    def encode(self):
+        entries, undated = self.sorted_entries()
+        return {"due": [[due, tk_hash, assign]
+                        for tk_hash, (due, assign) in entries],
+                "undated": undated}
+
+    def decode(self, data):
+        self.extend([(tk_hash, [due, assign])
+                      for due, tk_hash, assign in data["due"]],
+                     data["undated"])
+
+# Content hashes of every task and month file in a JSON store, arranged
+# as a Merkle tree so two stores are compared top down:
+#
+#   root -> "month"   -> month/0126, month/0226, ...
+#        -> "task/00" -> task/00..., one bucket per ref_id prefix
+#        -> ...
+#
+# A task hash covers its snapshot and journal. Hashes are kept in the
+# merkle file with the stamps of the files, so only files changed since
+# the last sync are read again.
+class MerkleTree:
+
+    def __init__(self, settings):
+        self.settings = settings
+        # bucket -> leaf name -> [stamp, hash]
+        self.buckets = {}
+
+    @staticmethod
+    def filename(settings):
+        return os.path.join(settings.config.path, "merkle")
+
+    @staticmethod
+    def bucket_name(leaf):
+        if leaf.startswith("task/"):
+            return leaf[:7]
+        return "month"
+
+    @staticmethod
+    def hash_files(paths):
+        import hashlib
+        digest = hashlib.sha256()
+        for path in paths:
+            try:
+                with open(path, "rb") as f:
+                    digest.update(f.read())
+            except FileNotFoundError:
+                pass
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    @staticmethod
+    def hash_children(hashes):
+        import hashlib
+        digest = hashlib.sha256()
+        for name in sorted(hashes):
+            digest.update(f"{name} {hashes[name]}\n".encode())
+        return digest.hexdigest()
+
+    # Bring every leaf up to date with the files on disk
+    @staticmethod
+    def load(settings):
+        self = MerkleTree(settings)
+        try:
+            with open(MerkleTree.filename(settings), "r") as f:
+                cached = json.load(f)
+        except FileNotFoundError:
+            cached = {}
+
+        storage = settings.storage
+        leaves = [(f"task/{tk_hash}", storage.task_paths(tk_hash))
+                  for tk_hash in storage.task_hashes()]
+        leaves += [(f"month/{settings.month_name(date)}",
+                    storage.month_paths(date))
+                   for date in storage.month_dates()]
+        for leaf, paths in leaves:
+            bucket = MerkleTree.bucket_name(leaf)
+            # Same form as after a round trip through JSON
+            stamp = [None if part is None else list(part)
+                     for part in file_stamp(paths)]
+            entry = cached.get(bucket, {}).get(leaf)
+            if entry is None or entry[0] != stamp:
+                entry = [stamp, MerkleTree.hash_files(paths)]
+            self.buckets.setdefault(bucket, {})[leaf] = entry
+        return self
+
+    def save(self):
+        self.settings.write_file(MerkleTree.filename(self.settings),
+                                 json.dumps(self.buckets))
+
+    def bucket_hashes(self):
+        return {bucket: MerkleTree.hash_children(
+                    {leaf: entry[1] for leaf, entry in leaves.items()})
+                for bucket, leaves in self.buckets.items()}
+
+    def root(self):
+        return MerkleTree.hash_children(self.bucket_hashes())
+
+    # Leaf names whose hashes differ, only looking inside buckets which
+    # don't match
+    def diff(self, other):
+        if self.root() == other.root():
+            return []
+        ours, theirs = self.bucket_hashes(), other.bucket_hashes()
+        leaves = []
+        for bucket in sorted(set(ours) | set(theirs)):
+            if ours.get(bucket) == theirs.get(bucket):
+                continue
+            our_leaves = self.buckets.get(bucket, {})
+            their_leaves = other.buckets.get(bucket, {})
+            for leaf in sorted(set(our_leaves) | set(their_leaves)):
+                our_hash = our_leaves.get(leaf, [None, None])[1]
+                if our_hash != their_leaves.get(leaf, [None, None])[1]:
+                    leaves.append(leaf)
+        return leaves
+
+# Split the time from start to end into (month name, seconds) pieces
+def month_spans(start, end, settings):
+    spans = []
+    date = datetime.datetime.fromtimestamp(start)
+    year, month = date.year, date.month
+    while start < end:
+        name = settings.month_name(datetime.datetime(year, month, 1))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        boundary = min(end, datetime.datetime(year, month, 1).timestamp())
+        spans.append((name, boundary - start))
+        start = boundary
+    return spans
+
+# Batch many operations into a single write per touched file:
+#
+#   with TaskStore(settings):
+#       ...
+#
+# Objects saved inside the block are kept in memory, loads return those
+# same objects, and everything is written once when the block exits.
+# Nothing is written if the block raises.
+class TaskStore:
+
+    def __init__(self, settings):
+        self.settings = settings
+        # key -> object loaded or saved during the transaction
+        self.objects = {}
+        # Objects waiting to be written, one dict per flush_order
+        self.dirty = [{}, {}, {}]
+        # Writer locks kept until the flush is done
+        self.locks = contextlib.ExitStack()
+        self.held = set()
+
+    def __enter__(self):
+        assert self.settings.store is None
+        self.settings.store = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                with self.locks:
+                    self.flush()
+            else:
+                # Locks which are database transactions roll back
+                self.locks.__exit__(exc_type, exc_value, traceback)
+        finally:
+            self.settings.store = None
+
+    def stage(self, key, obj):
+        self.objects[key] = obj
+        self.dirty[obj.flush_order][key] = obj
+
+    def hold(self, key, lock):
+        if key in self.held:
+            return
+        self.locks.enter_context(lock)
+        self.held.add(key)
+        # Drop what was only read before, it may be stale. Anything staged
+        # is our own change, eg. a new task being activated, and stays.
+        if not any(key in dirty for dirty in self.dirty):
+            self.objects.pop(key, None)
+
+    # Writing tasks and months updates the index, so flush in order and
+    # the index is only written once at the end.
+    def flush(self):
+        self.settings.sync_dirs = set()
+        try:
+            with self.settings.storage.transaction():
+                for dirty in self.dirty:
+                    while dirty:
+                        key = next(iter(dirty))
+                        dirty.pop(key).write()
+            sync_dirs = self.settings.sync_dirs
+        finally:
+            self.settings.sync_dirs = None
+        for dirname in sync_dirs:
+            self.settings.sync_dir(dirname)
+
+# Where tasks and months are kept. Both backends provide:
+#
+#   load_task(tk_hash) / write_task(tk) / task_paths(tk_hash)
+#   load_tasks(tk_hashes)            several tasks, in the given order
+#   load_month(date) / write_month(month_tks) / month_paths(date)
+#   create_month(month_tks)          write a new month unless it exists,
+#                                    returns False if it already did
+#   lock_month(date)                 context manager excluding other
+#                                    writers of the month, never readers
+#   lock_task(tk_hash)               the same for a task
+#   records(tk_hashes)               TaskRecords in the given order
+#   iter_records(tk_hashes)          the same, lazily from any iterable
+#   open_records(month_tks, project_prefix)
+#   project_states(month_tks)        (project, state) of open tasks
+#   task_hashes() / month_dates()   everything stored, for migrations
+#   reindex()                        returns the number of tasks
+#   transaction()                    context manager grouping writes
+#
+# The *_paths() methods name the files to stat to see if a cached
+# object is still current.
+def open_storage(settings):
+    backend = os.environ.get("TAU_STORAGE")
+    if backend is None:
+        # Once migrated, the database takes over
+        if os.path.exists(SqliteStorage.filename(settings)):
+            backend = "sqlite"
+        else:
+            backend = "json"
+
+    if backend == "json":
+        return JsonStorage(settings)
+    elif backend == "sqlite":
+        return SqliteStorage(settings)
+    error(f"unknown storage backend {backend}")
+
+# Parsed tasks pickled under cache/ so unchanged tasks skip the JSON
+# parsing. An entry is only used while the stamps of the task and journal
+# files match the ones it was saved with, so edited or synced files are
+# always reread. Past TAU_CACHE_SIZE entries the least recently used are
+# pruned, each entry's mtime being when it was last written or hit.
+#
+# Off unless TAU_CACHE=1. Unpickling a task costs about as much as
+# parsing its JSON, and tau log over 30000 tasks took 2.2s without the
+# cache against 3.4s warm with a full one. It can still pay off where
+# reading the files is slow, or for tasks with long journals.
+class TaskCache:
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.path = os.path.join(settings.config.path, "cache")
+        self.max_entries = int(os.environ.get("TAU_CACHE_SIZE", 10000))
+        # Entries written by this process, the size is checked every
+        # CACHE_PRUNE_INTERVAL of them
+        self.puts = 0
+
+    def filename(self, tk_hash):
+        return os.path.join(self.path, tk_hash)
+
+    def get(self, tk_hash, stamp):
+        import pickle
+
+        filename = self.filename(tk_hash)
+        try:
+            with open(filename, "rb") as f:
+                version, cached_stamp, state = pickle.load(f)
+                used = os.fstat(f.fileno()).st_mtime
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.debug(f"ignoring bad cache entry {filename}: {e}")
+            return None
+
+        if version != CACHE_VERSION or cached_stamp != stamp:
+            return None
+        # Access times are often not kept, so a hit bumps the mtime.
+        # Not on every hit, that would be a write per task read.
+        if time.time() - used > CACHE_TOUCH_INTERVAL:
+            try:
+                os.utime(filename)
+            except FileNotFoundError:
+                pass
+        tk = TaskInfo.__new__(TaskInfo)
+        tk.__setstate__(state)
+        tk.comments = [Comment(*comment) for comment in tk.comments]
+        tk.settings = self.settings
+        self.settings.count("cache hits")
+        return tk
+
+    def put(self, tk_hash, stamp, tk):
+        import pickle
+
+        # Only builtin types are pickled. Classes would be pickled by
+        # module, which is __main__ for tau but tau for simulate.py, and
+        # loading those would import tau a second time.
+        state = tk.__getstate__()
+        state["comments"] = [(comment.content, comment.author,
+                              comment.created) for comment in tk.comments]
+
+        # Write on the side so readers never see half an entry
+        temp_filename = os.path.join(self.path,
+                                     f".{tk_hash}.{os.getpid()}.tmp")
+        try:
+            f = open(temp_filename, "wb")
+        except FileNotFoundError:
+            make_path(self.path)
+            f = open(temp_filename, "wb")
+        with f:
+            pickle.dump((CACHE_VERSION, stamp, state), f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_filename, self.filename(tk_hash))
+
+        if self.puts % CACHE_PRUNE_INTERVAL == 0:
+            self.prune()
+        self.puts += 1
+
+    def discard(self, tk_hash):
+        try:
+            os.remove(self.filename(tk_hash))
+        except FileNotFoundError:
+            pass
+
+    # Drop the least recently used entries
+    def prune(self):
+        entries = []
+        for entry in os.scandir(self.path):
+            # Hidden names are other writers' temp files
+            if entry.name.startswith("."):
+                continue
+            try:
+                entries.append((entry.stat().st_mtime, entry.path))
+            except FileNotFoundError:
+                continue
+        if len(entries) <= self.max_entries:
+            return
+        entries.sort()
+        # Leave some headroom so we don't prune on every check
+        excess = len(entries) - self.max_entries * 9 // 10
+        for mtime, path in entries[:excess]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+# One JSON file per task under task/ plus its journal under journal/,
+# and one file per month under month/
+class JsonStorage:
+
+    def __init__(self, settings):
+        self.settings = settings
+        if os.environ.get("TAU_CACHE", "0") == "0":
+            self.cache = None
+        else:
+            self.cache = TaskCache(settings)
+
+    def task_path(self, tk_hash):
+        return os.path.join(self.settings.config.path, f"task/{tk_hash}")
+
+    def journal_path(self, tk_hash):
+        return os.path.join(self.settings.config.path, f"journal/{tk_hash}")
+
+    def task_paths(self, tk_hash):
+        return [self.task_path(tk_hash), self.journal_path(tk_hash)]
+
+    def month_paths(self, date):
+        return [self.settings.month_filename(date)]
+
+    def load_task(self, tk_hash):
+        for attempt in range(JOURNAL_READ_ATTEMPTS):
+            # Stat before reading. If the files change in between, the
+            # entry will just be stale next time.
+            stamp = file_stamp(self.task_paths(tk_hash))
+            if self.cache is not None:
+                tk = self.cache.get(tk_hash, stamp)
+                if tk is not None:
+                    return tk
+
+            data = self.settings.read_json(self.task_path(tk_hash))
+            tk = TaskInfo.from_header_json(tk_hash, data, self.settings,
+                                           data["events"], data["comments"])
+            tk.journal_gen = data.get("journal", 0)
+            if self.replay_journal(tk):
+                break
+            # Compacted while we read, so there is a newer snapshot
+        else:
+            logging.warning(f"journal of {tk_hash} is newer than its task "
+                            f"file, ignoring it")
+
+        if self.cache is not None:
+            self.cache.put(tk_hash, stamp, tk)
+        return tk
+
+    # Per-file latency dominates on network mounted homes, so keep
+    # several reads in flight. map() preserves the order.
+    def load_tasks(self, tk_hashes):
+        workers = min(self.settings.workers, len(tk_hashes))
+        if workers <= 1:
+            return [self.load_task(tk_hash) for tk_hash in tk_hashes]
+
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(self.load_task, tk_hashes))
+
+    # Events and comments are appended to the journal. The whole task is
+    # only rewritten for new tasks, header changes or once the journal
+    # grows past JOURNAL_COMPACT_SIZE records.
+    def write_task(self, tk):
+        if (tk.needs_snapshot or not tk.saved or
+            tk.journal_len + len(tk.pending) > JOURNAL_COMPACT_SIZE):
+            self.write_snapshot(tk)
+        elif tk.pending:
+            self.append_journal(tk)
+
+        # Not replaced with our copy: the next load caches it under a
+        # stamp taken before reading, which can never be stale
+        if self.cache is not None:
+            self.cache.discard(tk.tk_hash())
+
+        index = TaskIndex.for_task(tk.ref_id, self.settings)
+        if index.update(tk):
+            index.save()
+
+    # Readers don't take the task lock, so the journal is never removed.
+    # Once the snapshot has taken the journal in it moves to the next
+    # generation, and the journal is replaced by an empty one of that
+    # generation. A reader pairing the new snapshot with the old journal
+    # ignores the journal, one pairing the old snapshot with the new
+    # journal reads the task again.
+    def write_snapshot(self, tk):
+        tk_hash = tk.tk_hash()
+        if tk.saved:
+            new_journal = tk.journal_len > 0
+        else:
+            # Eg. a synced copy replacing a task with a journal here
+            generation = self.journal_generation(tk_hash)
+            new_journal = generation is not None
+            tk.journal_gen = generation or 0
+        if new_journal:
+            tk.journal_gen += 1
+
+        data = tk.header_json()
+        data["events"] = tk.events_json()
+        data["comments"] = tk.comments_json()
+        data["journal"] = tk.journal_gen
+        self.settings.write_file(self.task_path(tk_hash),
+                                 json.dumps(data, indent=4))
+
+        if new_journal:
+            self.settings.write_file(self.journal_path(tk_hash),
+                                     self.journal_header(tk))
+        tk.journal_len = 0
+        tk.pending = []
+        tk.saved = True
+        tk.needs_snapshot = False
+
+    def append_journal(self, tk):
+        # A single append, so concurrent writers never interleave lines
+        text = "".join(json.dumps(record) + "\n" for record in tk.pending)
+        with open(self.journal_path(tk.tk_hash()), "a+b") as f:
+            # Finish off a torn record from an interrupted append, or our
+            # first record would be read as part of it
+            end = f.tell()
+            if end > 0:
+                f.seek(end - 1)
+                if f.read(1) != b"\n":
+                    text = "\n" + text
+            elif tk.journal_gen > 0:
+                text = self.journal_header(tk) + text
+            f.write(text.encode())
+            if self.settings.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        tk.journal_len += len(tk.pending)
+        tk.pending = []
+
+    # First line of a journal after the first compaction
+    @staticmethod
+    def journal_header(tk):
+        return json.dumps({"type": "journal",
+                           "generation": tk.journal_gen}) + "\n"
+
+    @staticmethod
+    def header_generation(line):
+        try:
+            record = json.loads(line)
+        except ValueError:
+            return 0
+        if record.get("type") != "journal":
+            return 0
+        return record["generation"]
+
+    # Generation of the journal on disk, or None if there is none
+    def journal_generation(self, tk_hash):
+        try:
+            with open(self.journal_path(tk_hash), "r") as f:
+                return self.header_generation(f.readline())
+        except FileNotFoundError:
+            return None
+
+    # Returns False if the journal is newer than the snapshot tk came from
+    def replay_journal(self, tk):
+        try:
+            with open(self.journal_path(tk.tk_hash()), "r") as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return True
+        self.settings.count("files read")
+        self.settings.count("bytes parsed", sum(len(line) for line in lines))
+
+        # Journals from before the first compaction have no header
+        generation = self.header_generation(lines[0]) if lines else 0
+        if generation > tk.journal_gen:
+            return False
+        if generation < tk.journal_gen:
+            # Already part of the snapshot
+            return True
+
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Torn write from an interrupted append
+                logging.warning(f"skipping bad journal record for "
+                                f"{tk.tk_hash()}: {line!r}")
+                continue
+            if record["type"] == "journal":
+                continue
+            tk.replay(record)
+            tk.journal_len += 1
+        return True
+
+    def load_month(self, date):
+        data = self.settings.read_json(self.settings.month_filename(date))
+        return MonthTasks.from_json(data, self.settings)
+
+    def write_month(self, month_tks):
+        self.settings.write_file(month_tks.filename(),
+                                 json.dumps(month_tks.to_json(), indent=4))
+
+    def create_month(self, month_tks):
+        filename = month_tks.filename()
+        temp_filename = self.settings.write_file(
+            filename, json.dumps(month_tks.to_json(), indent=4),
+            rename=False)
+        try:
+            # Unlike a rename, link fails if the month is already there
+            # and the file is never seen half written
+            os.link(temp_filename, filename)
+        except FileExistsError:
+            return False
+        finally:
+            os.remove(temp_filename)
+        self.settings.sync_dir(os.path.dirname(filename))
+        return True
+
+    # Tasks missing from the index, eg. from before it existed, are added
+    # as they are read
+    def records(self, tk_hashes):
+        return TaskIndex.records(tk_hashes, self.settings)
+
+    def iter_records(self, tk_hashes):
+        shards = {}
+        for chunk in chunked(tk_hashes, 256):
+            yield from TaskIndex.records(chunk, self.settings, shards)
+
+    def open_records(self, month_tks, project_prefix=None):
+        return TaskIndex.open_records(month_tks.task_tks, self.settings,
+                                      project_prefix)
+
+    def project_states(self, month_tks):
+        return TaskIndex.project_states(month_tks.task_tks, self.settings)
+
+    def task_hashes(self):
+        # Hidden names are temp and lock files
+        return sorted(name for name in os.listdir(
+            os.path.join(self.settings.config.path, "task"))
+            if not name.startswith("."))
+
+    def month_dates(self):
+        month_path = os.path.join(self.settings.config.path, "month")
+        return [month_date(name) for name in sorted(os.listdir(month_path))
+                if not name.startswith(".")]
+
+    def reindex(self):
+        return TaskIndex.rebuild(self.settings)
+
+    def lock_month(self, date):
+        return file_lock(self.settings.month_filename(date))
+
+    # Split over 16 lock files by the first digit, the kernel scans every
+    # range held on a file when taking another
+    def lock_task(self, tk_hash):
+        return range_lock(os.path.join(self.settings.config.path, "task",
+                                       tk_hash[:1]), tk_hash)
+
+    def transaction(self):
+        return contextlib.nullcontext()
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    ref_id TEXT PRIMARY KEY,
+    id INTEGER NOT NULL,
+    title TEXT,
+    desc TEXT,
+    assign TEXT,
+    project TEXT,
+    -- ISO date so it sorts
+    due TEXT,
+    -- Exact decimal as text
+    rank TEXT,
+    state TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+-- Only the project prefix is filtered in SQL, see open_records().
+-- Older databases also had these, and a rank_value column which is
+-- left in place and no longer written.
+CREATE INDEX IF NOT EXISTS tasks_project ON tasks(project);
+DROP INDEX IF EXISTS tasks_assign;
+DROP INDEX IF EXISTS tasks_state;
+DROP INDEX IF EXISTS tasks_due;
+DROP INDEX IF EXISTS tasks_created_at;
+
+CREATE TABLE IF NOT EXISTS events (
+    seq INTEGER PRIMARY KEY,
+    ref_id TEXT NOT NULL,
+    action TEXT NOT NULL,
+    timestamp REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_ref_id ON events(ref_id);
+
+CREATE TABLE IF NOT EXISTS comments (
+    seq INTEGER PRIMARY KEY,
+    ref_id TEXT NOT NULL,
+    content TEXT,
+    author TEXT,
+    timestamp REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS comments_ref_id ON comments(ref_id);
+
+CREATE TABLE IF NOT EXISTS months (
+    name TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS month_tasks (
+    month TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    ref_id TEXT NOT NULL,
+    PRIMARY KEY (month, position)
+);
+"""
+
+# Everything in a single {config}/tau.db
+class SqliteStorage:
+
+    def __init__(self, settings, filename=None):
+        import sqlite3
+
+        self.settings = settings
+        if filename is None:
+            filename = SqliteStorage.filename(settings)
+        self.path = filename
+        # Transactions are managed by transaction()
+        self.db = sqlite3.connect(filename, isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SQLITE_SCHEMA)
+        self.depth = 0
+
+    @staticmethod
+    def filename(settings):
+        return os.path.join(settings.config.path, "tau.db")
+
+    def task_paths(self, tk_hash):
+        return [self.path]
+
+    def month_paths(self, date):
+        return [self.path]
+
+    # Taking the write lock up front stops two writers from both reading
+    # the month before either has written it. Readers carry on.
+    def lock_month(self, date):
+        return self.transaction(immediate=True)
+
+    def lock_task(self, tk_hash):
+        return self.transaction(immediate=True)
+
+    @contextlib.contextmanager
+    def transaction(self, immediate=False):
+        if self.depth == 0:
+            self.db.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+        self.depth += 1
+        try:
+            yield
+        except BaseException:
+            self.depth -= 1
+            if self.depth == 0:
+                self.db.execute("ROLLBACK")
+            raise
+        self.depth -= 1
+        if self.depth == 0:
+            self.db.execute("COMMIT")
+
+    @staticmethod
+    def header_json(row):
+        if row["due"] is None:
+            due = None
+        else:
+            due = datetime.date.fromisoformat(row["due"]).strftime("%d%m%y")
+        return {
+            "id": row["id"],
+            "title": row["title"],
+            "desc": row["desc"],
+            "assign": row["assign"],
+            "project": row["project"],
+            "due": due,
+            "rank": row["rank"],
+            "created_at": row["created_at"],
+        }
+
+    @staticmethod
+    def make_record(row):
+        due = row["due"]
+        if due is not None:
+            due = datetime.date.fromisoformat(due)
+        rank = row["rank"]
+        if rank is not None:
+            rank = Real(rank)
+        created_at = datetime.datetime.fromtimestamp(row["created_at"])
+        return TaskRecord(
+            row["ref_id"], row["id"], row["title"], row["project"],
+            row["assign"], due, rank, row["state"], created_at)
+
+    def load_task(self, tk_hash):
+        row = self.db.execute("SELECT * FROM tasks WHERE ref_id = ?",
+                              (tk_hash,)).fetchone()
+        if row is None:
+            raise FileNotFoundError(f"task {tk_hash} not in {self.path}")
+
+        raw_events = [
+            {"action": action, "timestamp": timestamp}
+            for action, timestamp in self.db.execute(
+                "SELECT action, timestamp FROM events "
+                "WHERE ref_id = ? ORDER BY seq", (tk_hash,))
+        ]
+        raw_comments = [
+            {"content": content, "author": author, "timestamp": timestamp}
+            for content, author, timestamp in self.db.execute(
+                "SELECT content, author, timestamp FROM comments "
+                "WHERE ref_id = ? ORDER BY seq", (tk_hash,))
+        ]
+        return TaskInfo.from_header_json(
+            tk_hash, SqliteStorage.header_json(row), self.settings,
+            raw_events, raw_comments)
+
+    # The connection belongs to this thread, and the reads are all
+    # local anyway
+    def load_tasks(self, tk_hashes):
+        return [self.load_task(tk_hash) for tk_hash in tk_hashes]
+
+    def write_task(self, tk):
+        tk_hash = tk.tk_hash()
+        with self.transaction():
+            if tk.needs_snapshot or not tk.saved:
+                if tk.due is None:
+                    due = None
+                else:
+                    due = tk.due.isoformat()
+                if tk.rank is None:
+                    rank = None
+                else:
+                    rank = str(tk.rank)
+                self.db.execute(
+                    "INSERT OR REPLACE INTO tasks (ref_id, id, title, desc, "
+                    "assign, project, due, rank, state, created_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (tk_hash, tk.id, tk.title, tk.desc, tk.assign,
+                     tk.project, due, rank, tk.get_state(),
+                     tk.created_at.timestamp()))
+            else:
+                self.db.execute("UPDATE tasks SET state = ? WHERE ref_id = ?",
+                                (tk.get_state(), tk_hash))
+
+            if tk.saved:
+                events = [record for record in tk.pending
+                          if record["type"] == "event"]
+                comments = [record for record in tk.pending
+                            if record["type"] == "comment"]
+            else:
+                # Replace whatever history was there
+                self.db.execute("DELETE FROM events WHERE ref_id = ?",
+                                (tk_hash,))
+                self.db.execute("DELETE FROM comments WHERE ref_id = ?",
+                                (tk_hash,))
+                events = tk.events_json()
+                comments = tk.comments_json()
+
+            self.db.executemany(
+                "INSERT INTO events (ref_id, action, timestamp) "
+                "VALUES (?, ?, ?)",
+                [(tk_hash, event["action"], event["timestamp"])
+                 for event in events])
+            self.db.executemany(
+                "INSERT INTO comments (ref_id, content, author, timestamp) "
+                "VALUES (?, ?, ?, ?)",
+                [(tk_hash, comment["content"], comment["author"],
+                  comment["timestamp"]) for comment in comments])
+
+        tk.pending = []
+        tk.saved = True
+        tk.needs_snapshot = False
+
+    def load_month(self, date):
+        name = self.settings.month_name(date)
+        row = self.db.execute("SELECT data FROM months WHERE name = ?",
+                              (name,)).fetchone()
+        if row is None:
+            raise FileNotFoundError(f"month {name} not in {self.path}")
+        return MonthTasks.from_json(json.loads(row["data"]), self.settings)
+
+    def write_month(self, month_tks):
+        name = self.settings.month_name(month_tks.created_at)
+        with self.transaction():
+            self.db.execute("INSERT OR REPLACE INTO months VALUES (?, ?)",
+                            (name, json.dumps(month_tks.to_json())))
+            self.db.execute("DELETE FROM month_tasks WHERE month = ?",
+                            (name,))
+            self.db.executemany(
+                "INSERT INTO month_tasks VALUES (?, ?, ?)",
+                [(name, position, tk_hash)
+                 for position, tk_hash in enumerate(month_tks.task_tks)])
+
+    def create_month(self, month_tks):
+        import sqlite3
+        try:
+            with self.transaction():
+                self.db.execute("INSERT INTO months VALUES (?, ?)",
+                                (self.settings.month_name(month_tks.created_at),
+                                 json.dumps(month_tks.to_json())))
+                self.write_month(month_tks)
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    def records(self, tk_hashes):
+        tk_hashes = list(tk_hashes)
+        records = {}
+        # Stay under the SQLite bound parameter limit
+        for i in range(0, len(tk_hashes), 500):
+            chunk = tk_hashes[i:i + 500]
+            placeholders = ", ".join("?" * len(chunk))
+            for row in self.db.execute(
+                    f"SELECT * FROM tasks WHERE ref_id IN ({placeholders})",
+                    chunk):
+                records[row["ref_id"]] = SqliteStorage.make_record(row)
+        return [records[tk_hash] for tk_hash in tk_hashes]
+
+    def iter_records(self, tk_hashes):
+        for chunk in chunked(tk_hashes, 500):
+            yield from self.records(chunk)
+
+    def open_records(self, month_tks, project_prefix=None):
+        query = (
+            "SELECT tasks.* FROM month_tasks "
+            "JOIN tasks ON tasks.ref_id = month_tasks.ref_id "
+            "WHERE month_tasks.month = ? AND tasks.state != 'stop'"
+        )
+        params = [self.settings.month_name(month_tks.created_at)]
+        if project_prefix:
+            # Range scan on the project index, same as startswith()
+            query += " AND tasks.project >= ? AND tasks.project < ?"
+            params += [project_prefix, prefix_upper_bound(project_prefix)]
+        query += " ORDER BY month_tasks.position"
+        return [SqliteStorage.make_record(row)
+                for row in self.db.execute(query, params)]
+
+    def project_states(self, month_tks):
+        rows = self.db.execute(
+            "SELECT tasks.project, tasks.state, COUNT(*) FROM month_tasks "
+            "JOIN tasks ON tasks.ref_id = month_tasks.ref_id "
+            "WHERE month_tasks.month = ? AND tasks.state != 'stop' "
+            "AND tasks.project IS NOT NULL "
+            "GROUP BY tasks.project, tasks.state",
+            (self.settings.month_name(month_tks.created_at),))
+        states = []
+        for project, state, count in rows:
+            states += [(project, state)] * count
+        return states
+
+    def task_hashes(self):
+        return [row["ref_id"] for row in self.db.execute(
+            "SELECT ref_id FROM tasks ORDER BY ref_id")]
+
+    def month_dates(self):
+        return [month_date(row["name"]) for row in self.db.execute(
+            "SELECT name FROM months")]
+
+    def reindex(self):
+        self.db.execute("REINDEX")
+        return self.db.execute("SELECT COUNT(*) FROM tasks").fetchone()[0]
+
+# Exclusive advisory lock for writers of filename. Files are replaced
+# rather than rewritten, so the lock lives on a hidden file beside it.
+# Readers never take it and always see a whole file.
+@contextlib.contextmanager
+def file_lock(filename):
+    import fcntl
+    dirname, basename = os.path.split(filename)
+    fd = os.open(os.path.join(dirname, f".{basename}.lock"),
+                 os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        # Closing releases the lock
+        os.close(fd)
+
+# Descriptors of the files range_lock() has opened, kept for the life of
+# the process as closing one would drop every lock held on that file
+range_lock_fds = {}
+
+# Like file_lock(), but for one key of many sharing a lock file. Each key
+# locks a byte range of it, so a TaskStore holding thousands of task
+# locks needs a single descriptor. The locks belong to the process, so
+# it must not take the same key twice at once.
+@contextlib.contextmanager
+def range_lock(filename, key):
+    import fcntl
+    import hashlib
+    fd = range_lock_fds.get(filename)
+    if fd is None:
+        dirname, basename = os.path.split(filename)
+        fd = os.open(os.path.join(dirname, f".{basename}.lock"),
+                     os.O_RDWR | os.O_CREAT, 0o644)
+        range_lock_fds[filename] = fd
+    offset = int.from_bytes(hashlib.blake2b(key.encode(),
+                                            digest_size=7).digest(), "big")
+    fcntl.lockf(fd, fcntl.LOCK_EX, 1, offset)
+    try:
+        yield
+    finally:
+        fcntl.lockf(fd, fcntl.LOCK_UN, 1, offset)
+
+# Lists of up to size items from any iterable
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+# Smallest string greater than every string starting with prefix
+def prefix_upper_bound(prefix):
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+# Inverse of Settings.month_name()
+def month_date(name):
+    month, year = int(name[:2]), int(name[2:]) + 2000
+    return datetime.datetime(year, month, 1)
+
 def read_description(settings):
+    import tempfile
     temp = tempfile.NamedTemporaryFile()
     temp.write(b"\n")
     temp.write(b"# Write task description above this line\n")
@@ -370,6 +2562,7 @@ def read_description(settings):
     return desc
 
 def read_comment(settings):
+    import tempfile
     temp = tempfile.NamedTemporaryFile()
     temp.write(b"\n")
     temp.write(b"# Write comment above this line\n")
@@ -382,30 +2575,43 @@ def read_comment(settings):
                      if line and line[0] != "#")
     return comment
 
-def load_current_open_tasks(settings):
+def load_current_open_tasks(settings, project_prefix=None):
     now = datetime.datetime.now()
     month_tks = MonthTasks.load_or_create(now, settings)
-    # Return only tasks which remain open
-    tks = [tk for tk in month_tks.objects() if tk.get_state() != "stop"]
+    # Summaries come from the index rather than every task file
+    tks = settings.storage.open_records(month_tks, project_prefix)
+    settings.count("tasks filtered", len(month_tks.task_tks) - len(tks))
     return tks
 
 def load_task_by_id(id, settings):
-    tks = load_current_open_tasks(settings)
-
-    tk = [tk for tk in tks if tk.id == id]
-    assert len(tk) <= 1
+    now = datetime.datetime.now()
+    month_tks = MonthTasks.load_or_create(now, settings)
 
-    if not tk:
+    tk_hash = month_tks.lookup_id(id)
+    if tk_hash is None:
         return None
 
-    return tk[0]
+    return TaskInfo.load(tk_hash, settings)
+
+def find_task_hash(id, settings):
+    now = datetime.datetime.now()
+    month_tks = MonthTasks.load_or_create(now, settings)
+    tk_hash = month_tks.lookup_id(id)
+    if tk_hash is None:
+        error(f"task ID {id} not found")
+    return tk_hash
+
+# Load a task to change it. It stays locked until the block ends, or
+# inside a TaskStore until it has been written.
+@contextlib.contextmanager
+def edit_task(tk_hash, settings):
+    with TaskInfo.lock(tk_hash, settings):
+        yield TaskInfo.load(tk_hash, settings)
 
 def find_free_id(settings):
-    tks = load_current_open_tasks(settings)
-    tk_ids = [tk.id for tk in tks]
-    for i in itertools.count():
-        if i not in tk_ids:
-            return i
+    now = datetime.datetime.now()
+    month_tks = MonthTasks.load_or_create(now, settings)
+    return month_tks.find_free_id()
 
 def cmd_add(args, settings):
     if not validate_due_date(args.due):
@@ -433,70 +2639,231 @@ def cmd_add(args, settings):
     task_info.activate()
     logging.info(f"{task_info}")
 
+# Records of every task listed in the months from since to until, each
+# once and in month order. Nothing is read until the caller asks for the
+# next record, so a consumer that stops early never touches later months.
+def iter_history(settings, since, until):
+    def tk_hashes():
+        seen = set()
+        for date in iter_months(since, until):
+            try:
+                month_tks = MonthTasks.load(date, settings)
+            except FileNotFoundError:
+                continue
+            for tk_hash in month_tks.task_tks:
+                if tk_hash not in seen:
+                    seen.add(tk_hash)
+                    yield tk_hash
+    return settings.storage.iter_records(tk_hashes())
+
+# Lazily keep the tasks matching predicate, counting the others
+def filter_tasks(settings, predicate, tks):
+    for tk in tks:
+        if predicate(tk):
+            yield tk
+        else:
+            settings.count("tasks filtered")
+
+def parse_month(value, option):
+    if len(value) != 4 or not is_integer(value):
+        error(f"{option} {value} is not in the format MMYY")
+    try:
+        return month_date(value)
+    except ValueError:
+        error(f"{option} {value} is not a valid month")
+
 def cmd_list(args, settings):
-    tks = load_current_open_tasks(settings)
+    project_prefix = args.project_prefix
+    if project_prefix is None:
+        project_prefix = args.project
+    history = args.since is not None or args.until is not None
+    if args.offset < 0:
+        error(f"--offset {args.offset} can't be negative")
+    if args.limit is not None and args.limit < 0:
+        error(f"--limit {args.limit} can't be negative")
+
+    if history or args.state is not None:
+        now = datetime.datetime.now()
+        if args.until is None:
+            until = now
+        else:
+            until = parse_month(args.until, "--until")
+        if args.since is None:
+            if history:
+                # From the first month there is
+                since = min(settings.storage.month_dates(), default=until)
+            else:
+                since = now
+        else:
+            since = parse_month(args.since, "--since")
+
+        tks = iter_history(settings, since, until)
+        if args.state is None:
+            tks = filter_tasks(settings,
+                               lambda tk: tk.get_state() != "stop", tks)
+        elif args.state != "all":
+            tks = filter_tasks(settings,
+                               lambda tk: tk.get_state() == args.state, tks)
+        if project_prefix is not None:
+            tks = filter_tasks(settings,
+                               lambda tk: tk.project is not None and
+                               tk.project.startswith(project_prefix), tks)
+    else:
+        tks = load_current_open_tasks(settings, project_prefix)
+
+    if args.assign is not None:
+        tks = filter_tasks(settings, lambda tk: tk.assign == args.assign, tks)
 
+    # Unranked tasks go last, like RankIndex leaves them out of the order
     def get_sort_key(tk):
         if tk.rank is None:
-            return 0
-        return tk.rank
+            return (False, 0)
+        return (True, tk.rank)
+
+    # Colors are relative to every task read, not just the page shown
+    rank_stats = RankStats()
+    tks = rank_stats.watch(tks)
+    offset = args.offset
+    if history:
+        # Keep month order, and stop reading as soon as we have enough
+        if args.limit is None:
+            tks = list(itertools.islice(tks, offset, None))
+        else:
+            tks = list(itertools.islice(tks, offset, offset + args.limit))
+    elif args.limit is None:
+        tks = sorted(tks, key=get_sort_key, reverse=True)[offset:]
+    else:
+        # Same order as sorting everything, keeping only a bounded heap
+        tks = heapq.nlargest(offset + args.limit, tks,
+                             key=get_sort_key)[offset:]
+    settings.mark("list: load and sort")
+    logging.debug(f"high rank: {rank_stats.high}")
+    logging.debug(f"low rank: {rank_stats.low}")
+    logging.debug(f"mean rank: {rank_stats.mean}")
+
+    if args.format == "table":
+        print_task_table(tks, history, rank_stats)
+    else:
+        print_task_fields(tks, history, args.format)
+    settings.mark("list: render")
+
+# Highest, lowest and mean rank, gathered as the tasks stream past
+class RankStats:
+
+    def __init__(self):
+        self.high = None
+        self.low = None
+        self.total = 0
+        self.count = 0
+
+    def add(self, rank):
+        if self.count == 0 or rank > self.high:
+            self.high = rank
+        if self.count == 0 or rank < self.low:
+            self.low = rank
+        self.total += rank
+        self.count += 1
+
+    def watch(self, tks):
+        for tk in tks:
+            if tk.rank is not None:
+                self.add(tk.rank)
+            yield tk
+
+    @property
+    def mean(self):
+        if self.count == 0:
+            return None
+        return self.total / self.count
+
+# Rows printed per tabulate call, so long lists start showing at once
+LIST_PAGE_SIZE = 100
+
+def print_task_table(tks, history, rank_stats):
+    from tabulate import tabulate
 
-    tks.sort(key=get_sort_key, reverse=True)
     headers = ["ID", "Title", "Project", "Assigned", "Due", "Rank"]
+    if history:
+        headers += ["State", "Created"]
+
+    for page_start in range(0, max(len(tks), 1), LIST_PAGE_SIZE):
+        table = []
+        for tk in tks[page_start:page_start + LIST_PAGE_SIZE]:
+            id, title, project, assign, due, rank = (
+                    tk.id, tk.title, tk.project, tk.assign, tk.due, tk.rank)
+
+            if tk.due is None:
+                due = None
+            else:
+                due = tk.due.strftime("%a %d %b")
+
+            # Apply color if task is started
+            state = tk.get_state()
+            if state == "start":
+                id = color_task(tk.id)
+                title = color_task(tk.title)
+                project = color_task(tk.project)
+                assign = color_task(tk.assign)
+                due = color_task(due)
+                rank = color_task(tk.rank)
+
+            rank = color_rank(tk.rank, rank_stats.high, rank_stats.low,
+                              rank_stats.mean)
+            row = [id, title, project, assign, due, rank]
+            if history:
+                row += [state, tk.created_at.strftime("%b %y")]
+            table.append(row)
+
+        if page_start:
+            print()
+        print(tabulate(table, headers=headers), flush=True)
+
+# Uncolored output for scripts: plain is the table's columns separated
+# by two spaces, tsv has a header and raw values, json one object per line
+def print_task_fields(tks, history, format):
+    names = ["id", "title", "project", "assign", "due", "rank", "state"]
+    if history:
+        names.append("created_at")
+    if format == "tsv":
+        print("\t".join(names))
 
-    # Extract ranks from task:
-    #   ranks = [tk.rank for tk in tks]
-    # Filter ranks by adding a conditional:
-    #   ... if tk.rank is not None
-    ranks = [tk.rank for tk in tks if tk.rank is not None]
-
-    high_rank = max(ranks)
-    logging.debug(f"high rank: {high_rank}")
-    low_rank = min(ranks)
-    logging.debug(f"low rank: {low_rank}")
-    mean_rank = sum(ranks)/len(ranks)
-    logging.debug(f"mean rank: {mean_rank}")
-
-    table = []
     for tk in tks:
-        id, title, project, assign, due, rank = (
-                tk.id, tk.title, tk.project, tk.assign, tk.due, tk.rank)
-
-        ### Apply prefix filter if needed
-        if args.project_prefix is not None:
-            if (tk.project is None
-                or not tk.project.startswith(args.project_prefix)):
-                continue
-
-        if tk.due is None:
-            due = None
+        due = tk.due
+        if format == "plain":
+            if due is not None:
+                due = due.strftime("%a %d %b")
+            values = [tk.id, tk.title, tk.project, tk.assign, due, tk.rank,
+                      tk.get_state()]
+            if history:
+                values.append(tk.created_at.strftime("%b %y"))
+            print("  ".join("-" if value is None else str(value)
+                            for value in values))
+            continue
+
+        if due is not None:
+            due = due.isoformat()
+        rank = None if tk.rank is None else str(tk.rank)
+        values = [tk.id, tk.title, tk.project, tk.assign, due, rank,
+                  tk.get_state()]
+        if history:
+            values.append(tk.created_at.isoformat(timespec="seconds"))
+        if format == "json":
+            print(json.dumps(dict(zip(names, values))))
         else:
-            due = tk.due.strftime("%a %d %b")
-
-        # Apply color if task is started
-        state = tk.get_state()
-        if state == "start":
-            id = color_task(tk.id)
-            title = color_task(tk.title)
-            project = color_task(tk.project)
-            assign = color_task(tk.assign)
-            due = color_task(due)
-            rank = color_task(tk.rank)
-
-        rank = color_rank(tk.rank, high_rank, low_rank, mean_rank)
-        table.append((id, title, project, assign, due, rank))
-
-    headers = ["ID", "Title", "Project", "Assigned", "Due", "Rank"]
-    print(tabulate(table, headers=headers))
+            # Tabs and newlines in titles would break the columns
+            print("\t".join("" if value is None else
+                            " ".join(str(value).split())
+                            for value in values))
 
 def color_rank(rank, high_rank, low_rank, mean_rank):
+    from colorama import Fore, Style
     if rank is None:
         return
     else:
-        if rank < mean_rank:
-            color = Fore.CYAN + Style.DIM
         if rank > mean_rank:
             color = Fore.CYAN
+        else:
+            color = Fore.CYAN + Style.DIM
         if rank == high_rank:
             color = Fore.CYAN + Style.BRIGHT
         if rank == low_rank: 
@@ -505,6 +2872,7 @@ def color_rank(rank, high_rank, low_rank, mean_rank):
         return colored_rank
 
 def color_task(task):
+    from colorama import Fore, Style
     if task is None:
         return
     else:
@@ -512,10 +2880,149 @@ def color_task(task):
         colored = color + str(task) + Style.RESET_ALL
         return colored
 
+def cmd_projects(args, settings):
+    from tabulate import tabulate
+
+    now = datetime.datetime.now()
+    month_tks = MonthTasks.load_or_create(now, settings)
+
+    # Count each task towards its project and every parent project
+    counts = {}
+    for project, state in settings.storage.project_states(month_tks):
+        names = project.split(".")
+        for depth in range(1, len(names) + 1):
+            node = ".".join(names[:depth])
+            node_counts = counts.setdefault(node, {})
+            node_counts[state] = node_counts.get(state, 0) + 1
+
+    table = []
+    for project in sorted(counts, key=lambda project: project.split(".")):
+        node_counts = counts[project]
+        depth = project.count(".")
+        name = "  " * depth + project.split(".")[-1]
+        open_count = node_counts.get("open", 0)
+        start_count = node_counts.get("start", 0)
+        pause_count = node_counts.get("pause", 0)
+        table.append((name, open_count, start_count, pause_count,
+                      sum(node_counts.values())))
+    headers = ["Project", "Open", "Started", "Paused", "Total"]
+    print(tabulate(table, headers=headers))
+
+def format_duration(seconds):
+    minutes = int(seconds // 60)
+    hours, minutes = divmod(minutes, 60)
+    days, hours = divmod(hours, 24)
+    if days:
+        return f"{days}d {hours}h"
+    if hours:
+        return f"{hours}h {minutes}m"
+    return f"{minutes}m"
+
+def cmd_stats(args, settings):
+    from tabulate import tabulate
+
+    now = datetime.datetime.now()
+    if args.since is None:
+        since = now
+    else:
+        since = parse_month(args.since, "--since")
+    if args.until is None:
+        until = since if args.since is not None else now
+    else:
+        until = parse_month(args.until, "--until")
+    if until < since:
+        error("stats range ends before it begins")
+
+    months = list(iter_months(since, until))
+    month_names = set(settings.month_name(date) for date in months)
+    range_start = months[0].timestamp()
+    range_end = next_month(until).timestamp()
+
+    tk_hashes, _ = month_range_tasks(settings, since, until)
+    entries = StatsIndex.entries(tk_hashes, settings)
+    records = settings.storage.records(tk_hashes)
+
+    # group -> [tasks, active seconds, stopped in range, cycle seconds]
+    groups = {}
+    timestamp = now.timestamp()
+    for tk in records:
+        entry = entries[tk.ref_id]
+        active = StatsIndex.active_time(entry, month_names, range_end,
+                                        timestamp, settings)
+        stopped = entry["stopped"]
+        done = stopped is not None and range_start <= stopped < range_end
+
+        if args.by == "task":
+            key = (tk.id, tk.title)
+        elif args.by == "assign":
+            key = tk.assign
+        else:
+            key = tk.project
+        group = groups.setdefault(key, [0, 0, 0, 0])
+        group[0] += 1
+        group[1] += active
+        if done:
+            group[2] += 1
+            group[3] += stopped - entry["created"]
+
+    table = []
+    for key, (count, active, done, cycle) in sorted(
+            groups.items(), key=lambda item: item[1][1], reverse=True):
+        if done:
+            cycle = format_duration(cycle / done)
+        else:
+            cycle = ""
+        if args.by == "task":
+            id, title = key
+            table.append((id, title, format_duration(active), cycle))
+        else:
+            name = "-" if key is None else key
+            table.append((name, count, format_duration(active), done, cycle))
+
+    if args.by == "task":
+        headers = ["ID", "Title", "Active", "Cycle"]
+    else:
+        headers = [args.by.capitalize(), "Tasks", "Active", "Done",
+                   "Mean cycle"]
+    print(tabulate(table, headers=headers))
+
+def cmd_search(args, settings):
+    from tabulate import tabulate
+
+    search_index = SearchIndex.load(settings)
+    if not search_index.complete:
+        filename = SearchIndex.meta_filename(settings)
+        with settings.hold_lock(filename, SearchIndex.lock(filename)):
+            search_index = SearchIndex.load(settings)
+            if not search_index.complete:
+                search_index = SearchIndex.build(settings)
+    results = search_index.search(" ".join(args.terms), args.limit)
+    if not results:
+        return
+
+    # Short ids only mean something for tasks open this month
+    now = datetime.datetime.now()
+    month_tks = MonthTasks.load_or_create(now, settings)
+    open_ids = {tk_hash: id for id, tk_hash in month_tks.ids.items()}
+
+    tks = settings.storage.records([tk_hash for _, tk_hash in results])
+    table = []
+    for (score, tk_hash), tk in zip(results, tks):
+        table.append((
+            open_ids.get(tk_hash, ""),
+            tk.title,
+            tk.project,
+            tk.get_state(),
+            tk.created_at.strftime("%b %Y"),
+            tk_hash[:8],
+            f"{score:.2f}",
+        ))
+    headers = ["ID", "Title", "Project", "State", "Created", "Ref", "Score"]
+    print(tabulate(table, headers=headers))
+
 def cmd_comment(args, settings):
-    tk = load_task_by_id(args.id, settings)
-    if tk is None:
-        error(f"task ID {args.id} not found")
+    tk_hash = find_task_hash(args.id, settings)
+    # Not while holding the lock, the editor may stay open a while
     if args.comment is None:
         comment = read_comment(settings)
     else:
@@ -524,14 +3031,17 @@ def cmd_comment(args, settings):
         author = "anon"
     else:
         author = args.author
-    tk.set_comment(comment, author)
-    tk.save()
-    print(tk)
+    with edit_task(tk_hash, settings) as tk:
+        tk.set_comment(comment, author)
+        tk.save()
+    if not args.quiet:
+        print(tk)
 
 def cmd_show(args, settings):
     tk = load_task_by_id(args.id, settings)
     if tk is None:
         error(f"task ID {args.id} not found")
+    from tabulate import tabulate
     print(tk)
 
     combined_log = tk.comments[:] + tk.events[:]
@@ -553,87 +3063,771 @@ def cmd_show(args, settings):
     print(tabulate(table))
 
 def cmd_start(args, settings):
-    tk = load_task_by_id(args.id, settings)
-    if tk is None:
-        error(f"task ID {args.id} not found")
-    tk.set_state("start")
-    tk.save()
+    with edit_task(find_task_hash(args.id, settings), settings) as tk:
+        tk.set_state("start")
+        tk.save()
 
 def cmd_pause(args, settings):
-    tk = load_task_by_id(args.id, settings)
-    if tk is None:
-        error(f"task ID {args.id} not found")
-    tk.set_state("pause")
-    tk.save()
+    with edit_task(find_task_hash(args.id, settings), settings) as tk:
+        tk.set_state("pause")
+        tk.save()
 
 def cmd_stop(args, settings):
-    tk = load_task_by_id(args.id, settings)
-    if tk is None:
+    with edit_task(find_task_hash(args.id, settings), settings) as tk:
+        tk.set_state("stop")
+        tk.save()
+
+    # Stopped tasks give up their short id
+    now = datetime.datetime.now()
+    with MonthTasks.lock(now, settings):
+        month_tks = MonthTasks.load_or_create(now, settings)
+        month_tks.release_id(tk.id, tk.tk_hash())
+        month_tks.save()
+
+# Move a task just above or below another in the list order. Normally
+# only the moved task is rewritten, with a rank between its new
+# neighbours; see RankIndex.place() for when the gap is too narrow.
+def cmd_rank(args, settings):
+    if (args.above is None) == (args.below is None):
+        error("give one of --above or --below")
+    above = args.above is not None
+    other_id = args.above if above else args.below
+    if other_id == args.id:
+        error(f"task ID {args.id} can't be ranked against itself")
+
+    now = datetime.datetime.now()
+    month_tks = MonthTasks.load_or_create(now, settings)
+    tk_hash = month_tks.lookup_id(args.id)
+    if tk_hash is None:
         error(f"task ID {args.id} not found")
-    tk.set_state("stop")
-    tk.save()
+    other_hash = month_tks.lookup_id(other_id)
+    if other_hash is None:
+        error(f"task ID {other_id} not found")
+
+    ranks = RankIndex.load(settings)
+    if ranks.sync(month_tks.task_tks):
+        ranks.save()
+    other_rank = ranks.data[other_hash]
+    if other_rank is None:
+        error(f"task ID {other_id} has no rank")
+
+    lower, upper = ranks.gap(other_rank, above, tk_hash)
+    new_ranks = ranks.place(tk_hash, lower, upper)
+    if len(new_ranks) > 1:
+        logging.info(f"spreading out {len(new_ranks) - 1} neighbours")
+
+    store = TaskStore(settings) if settings.store is None \
+        else contextlib.nullcontext()
+    with store:
+        # Kept by the store until it is flushed. In the same order
+        # everywhere, so two of us can't deadlock.
+        for tk_hash in sorted(new_ranks):
+            TaskInfo.lock(tk_hash, settings)
+        for tk in TaskInfo.load_many(list(new_ranks), settings):
+            old_rank = tk.rank
+            if old_rank == new_ranks[tk.ref_id]:
+                continue
+            tk.rank = new_ranks[tk.ref_id]
+            tk.save(compact=True)
+            # Now rather than at the flush, so the next rank in a batch
+            # sees it
+            ranks.update(tk)
+            print(f"{tk.id}: rank {old_rank} -> {tk.rank}")
+        ranks.save()
+
+# Number of days in 7d or 2w
+def parse_days(value, option):
+    units = {"d": 1, "w": 7}
+    count, unit = value[:-1], value[-1:]
+    if unit not in units or not count.isdigit():
+        error(f"{option} {value} is not a number of days or weeks: 7d, 2w")
+    return int(count) * units[unit]
+
+# Open tasks due within the next days, or already overdue. The summary
+# only reads the due index and the month, so it suits a shell prompt.
+def cmd_due(args, settings):
+    days = parse_days(args.within, "--within")
+    today = datetime.date.today()
+    # Due today counts as within, not overdue
+    end = today + datetime.timedelta(days=days + 1)
+
+    now = datetime.datetime.now()
+    month_tks = MonthTasks.load_or_create(now, settings)
+    index = DueIndex.load(settings)
+    if index.sync(month_tks.task_tks):
+        index.save()
+
+    overdue = index.due_between(None, today, args.assign)
+    if args.summary:
+        upcoming = index.due_between(today, end, args.assign)
+        parts = []
+        if overdue:
+            parts.append(f"{len(overdue)} overdue")
+        if upcoming:
+            parts.append(f"{len(upcoming)} due within {args.within}")
+        if parts:
+            print(", ".join(parts))
+        return
+
+    if args.overdue:
+        tk_hashes = overdue
+    else:
+        tk_hashes = index.due_between(today, end, args.assign)
+
+    from tabulate import tabulate
+    table = []
+    for tk in settings.storage.records(tk_hashes):
+        table.append((tk.id, tk.title, tk.project, tk.assign,
+                      tk.due.strftime("%a %d %b"), (tk.due - today).days))
+    headers = ["ID", "Title", "Project", "Assigned", "Due", "Days"]
+    print(tabulate(table, headers=headers))
+
+# First day of every month from start to end inclusive
+def iter_months(start, end):
+    year, month = start.year, start.month
+    while (year, month) <= (end.year, end.month):
+        yield datetime.datetime(year, month, 1)
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+# First day of the month after date
+def next_month(date):
+    if date.month == 12:
+        return datetime.datetime(date.year + 1, 1, 1)
+    return datetime.datetime(date.year, date.month + 1, 1)
+
+# Tasks listed in any month from start to end, each once, and whether
+# any of those months was logged at all
+def month_range_tasks(settings, start, end):
+    tk_hashes = {}
+    logged = False
+    for date in iter_months(start, end):
+        try:
+            month_tks = MonthTasks.load(date, settings)
+        except FileNotFoundError:
+            continue
+        logged = True
+        tk_hashes.update(dict.fromkeys(month_tks.task_tks))
+    return list(tk_hashes), logged
+
+# Returns a (days, projects) boolean matrix of which projects had a
+# started task on each day, along with the project names. tasks are
+# (project, totals) pairs, the totals from StatsIndex.
+#
+# A start interval marks the days from its start to its end as active.
+# Projects are rolled up to the first depth components, so crypto.zk
+# becomes crypto for depth=1.
+def project_activity(tasks, day_starts, depth, now):
+    import numpy as np
+
+    projects = {}
+    cols, begins, ends = [], [], []
+    for project, entry in tasks:
+        if project is None:
+            continue
+        project = ".".join(project.split(".")[:depth])
+        col = projects.setdefault(project, len(projects))
+        for begin, end in entry["spans"]:
+            cols.append(col)
+            begins.append(begin)
+            ends.append(end)
+        # Still running: active until today, or the end of the range
+        if entry["running"] is not None:
+            cols.append(col)
+            begins.append(entry["running"])
+            ends.append(now)
+
+    n_days = len(day_starts) - 1
+    if not begins:
+        return np.zeros((n_days, len(projects)), dtype=bool), list(projects)
+
+    # Local calendar day of each timestamp
+    day_starts = np.array(day_starts, dtype=np.float64)
+    start_day = np.searchsorted(day_starts, np.array(begins), "right") - 1
+    end_day = np.searchsorted(day_starts, np.array(ends), "right") - 1
+
+    in_range = (end_day >= 0) & (start_day < n_days) & (end_day >= start_day)
+    start_day = np.clip(start_day[in_range], 0, n_days - 1)
+    end_day = np.clip(end_day[in_range], 0, n_days - 1)
+    cols = np.array(cols, dtype=np.int64)[in_range]
+
+    # Difference array: +1 where an interval begins, -1 after it ends
+    diff = np.zeros((n_days + 1, len(projects)), dtype=np.int64)
+    np.add.at(diff, (start_day, cols), 1)
+    np.add.at(diff, (end_day + 1, cols), -1)
+    active = np.cumsum(diff, axis=0)[:-1] > 0
+    return active, list(projects)
 
 def cmd_log(args, settings):
+    try:
+        import numpy
+    except ImportError:
+        error("tau log needs numpy installed")
+    from tabulate import tabulate
+
     if args.date is None:
-        date = datetime.datetime.now().date()
+        start = datetime.datetime.now()
+    else:
+        start = parse_month(args.date, "date")
+    if args.until is None:
+        end = start
+    else:
+        end = parse_month(args.until, "until")
+    if end < start:
+        error("log range ends before it begins")
+
+    tk_hashes, logged = month_range_tasks(settings, start, end)
+    if not logged:
+        error("month is not logged")
+
+    # Projects from the index and start intervals from the totals, so no
+    # task is loaded in full
+    entries = StatsIndex.entries(tk_hashes, settings)
+    tasks = [(record.project, entries[record.ref_id])
+             for record in settings.storage.records(tk_hashes)]
+
+    first_day = datetime.date(start.year, start.month, 1)
+    after_last = next_month(end).date()
+    days = [first_day + datetime.timedelta(days=i)
+            for i in range((after_last - first_day).days)]
+    # Local midnight of every day, plus the end of the last one
+    day_starts = [
+        datetime.datetime.combine(day, datetime.time()).timestamp()
+        for day in days + [after_last]
+    ]
+
+    active, projects = project_activity(tasks, day_starts, args.depth,
+                                        time.time())
+
+    single_month = (start.year, start.month) == (end.year, end.month)
+    table = []
+    for day, row in zip(days, active.tolist()):
+        if single_month:
+            label = day.day
+        else:
+            label = day.strftime("%d %b %y")
+        table.append([label] + ["#" if cell else "" for cell in row])
+    print(tabulate(table, headers=["Day"] + projects))
+
+# Fields accepted by each batch operation and their defaults
+BATCH_OPERATIONS = {
+    "add": (cmd_add, {
+        "title": None, "desc": "", "assign": None, "project": None,
+        "due": None, "rank": None, "custom": None,
+    }),
+    "start": (cmd_start, {"id": None}),
+    "pause": (cmd_pause, {"id": None}),
+    "stop": (cmd_stop, {"id": None}),
+    "comment": (cmd_comment, {"id": None, "comment": None, "author": None}),
+    "rank": (cmd_rank, {"id": None, "above": None, "below": None}),
+}
+
+def batch_operation(line_number, data):
+    if not isinstance(data, dict):
+        error(f"line {line_number}: expected an object")
+    try:
+        func, defaults = BATCH_OPERATIONS[data["op"]]
+    except KeyError:
+        error(f"line {line_number}: unknown operation {data.get('op')}")
+
+    fields = dict(defaults)
+    for key, value in data.items():
+        if key == "op":
+            continue
+        if key not in fields:
+            error(f"line {line_number}: unknown field {key}")
+        fields[key] = value
+
+    if data["op"] == "add":
+        if fields["title"] is None:
+            error(f"line {line_number}: add needs a title")
+        if fields["rank"] is not None:
+            try:
+                fields["rank"] = Real(str(fields["rank"]))
+            except InvalidOperation:
+                fields["rank"] = None
+            if fields["rank"] is None or not fields["rank"].is_finite():
+                error(f"line {line_number}: invalid rank {data['rank']}")
+    elif data["op"] == "comment":
+        if fields["comment"] is None:
+            error(f"line {line_number}: comment needs a comment")
+        # One printed task per comment would swamp the output
+        fields["quiet"] = True
+
+    return func, argparse.Namespace(**fields)
+
+# Apply operations from a JSONL file, one object per line:
+#   {"op": "add", "title": "write spec", "project": "df.dao", "rank": 2}
+#   {"op": "start", "id": 0}
+#   {"op": "comment", "id": 0, "comment": "halfway", "author": "nar"}
+# Everything is applied in one transaction.
+def cmd_batch(args, settings):
+    if args.file is None or args.file == "-":
+        lines = sys.stdin
     else:
-        month, year = int(args.date[:2]), int(args.date[2:])
-        year += 2000
-        date = datetime.date(day=1, month=month, year=year)
+        lines = open(args.file, "r")
 
+    count = 0
+    with lines, TaskStore(settings):
+        for line_number, line in enumerate(lines, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                data = json.loads(line)
+            except ValueError as e:
+                error(f"line {line_number}: {e}")
+            func, op_args = batch_operation(line_number, data)
+            func(op_args, settings)
+            count += 1
+    logging.info(f"applied {count} operations")
+
+def cmd_reindex(args, settings):
+    count = settings.storage.reindex()
+    SearchIndex.rebuild(settings)
+    StatsIndex.rebuild(settings)
+    RankIndex.rebuild(settings)
+    DueIndex.rebuild(settings)
+    print(f"Indexed {count} tasks")
+
+# Copy a JSON tree into a new SQLite database which is then used
+# from here on. The JSON files are left in place.
+def cmd_migrate(args, settings):
+    filename = SqliteStorage.filename(settings)
+    if os.path.exists(filename):
+        error(f"{filename} already exists")
+
+    source = JsonStorage(settings)
+    # Build the database on the side so a failed migration leaves nothing
+    temp_filename = filename + ".tmp"
     try:
-        month = MonthTasks.load(date, settings)
+        os.remove(temp_filename)
     except FileNotFoundError:
-        error("month is not logged")
+        pass
+    dest = SqliteStorage(settings, temp_filename)
+
+    task_count = 0
+    with dest.transaction():
+        for tk_hash in source.task_hashes():
+            tk = source.load_task(tk_hash)
+            # Force a full write of the task and its history
+            tk.saved = False
+            dest.write_task(tk)
+            task_count += 1
+        for date in source.month_dates():
+            dest.write_month(source.load_month(date))
+    dest.db.close()
+    os.replace(temp_filename, filename)
+    print(f"Migrated {task_count} tasks to {filename}")
+
+# Copy of a task bound to other settings, written in full when saved
+def copy_task(tk, settings):
+    copy = TaskInfo.from_header_json(tk.ref_id, tk.header_json(), settings,
+                                     tk.events_json(), tk.comments_json())
+    copy.saved = False
+    return copy
+
+# Union of the history of two copies of the same task, in time order.
+# The header comes from whichever copy saw the latest activity.
+def merge_tasks(ours, theirs):
+    import array
+
+    def last_activity(tk):
+        times = list(tk.event_times)
+        times += [comment.created for comment in tk.comments]
+        return max(times, default=tk._created_at)
+
+    if last_activity(theirs) > last_activity(ours):
+        merged = copy_task(theirs, ours.settings)
+    else:
+        merged = copy_task(ours, ours.settings)
+
+    events = {(event["timestamp"], event["action"])
+              for tk in (ours, theirs) for event in tk.events_json()}
+    merged.event_actions = array.array("B")
+    merged.event_times = array.array("d")
+    for timestamp, action in sorted(events):
+        merged.add_event(action, timestamp)
+
+    comments = {(comment.created, comment.author, comment.content)
+                for tk in (ours, theirs) for comment in tk.comments}
+    merged.comments = [Comment(content, author, created)
+                       for created, author, content in sorted(comments)]
+    return merged
+
+# Both sides of a month, with the ids of open tasks reassigned where the
+# two sides handed out the same id. Returns the month and the tasks
+# whose short id changed.
+def merge_months(ours, theirs, settings):
+    merged = MonthTasks.from_json(ours.to_json(), settings)
+    for tk_hash in theirs.task_tks:
+        if tk_hash not in merged.task_tks:
+            merged.add(tk_hash)
+
+    states = {tk.ref_id: tk.get_state()
+              for tk in settings.storage.records(merged.task_tks)}
+    ids = {}
+    conflicts = []
+    for month_tks in (ours, theirs):
+        for id, tk_hash in sorted(month_tks.ids.items()):
+            if states[tk_hash] == "stop" or tk_hash in ids.values():
+                continue
+            if id in ids:
+                conflicts.append(tk_hash)
+            else:
+                ids[id] = tk_hash
+    # Open on one side but not yet given an id on the other
+    for tk_hash in merged.task_tks:
+        if (states[tk_hash] != "stop" and tk_hash not in ids.values() and
+            tk_hash not in conflicts):
+            conflicts.append(tk_hash)
+
+    merged.ids = {}
+    merged.free_ids = []
+    merged.next_id = 0
+    for id, tk_hash in sorted(ids.items()):
+        merged.claim_id(id, tk_hash)
+    renumbered = {}
+    for tk_hash in conflicts:
+        id = merged.find_free_id()
+        merged.claim_id(id, tk_hash)
+        renumbered[tk_hash] = id
+    return merged, renumbered
+
+def cmd_sync(args, settings):
+    if not isinstance(settings.storage, JsonStorage):
+        error("tau sync needs both stores to use JSON storage")
+    path = args.path
+    if not os.path.isdir(path):
+        error(f"{path} is not a directory")
+    if os.path.exists(os.path.join(path, "tau.db")):
+        error(f"{path} uses SQLite storage, tau sync needs JSON")
+    for subdir in ("task", "month", "journal"):
+        make_path(path, subdir)
+    config = Config(path)
+    config.load()
+    remote = Settings(config)
+    remote._storage = JsonStorage(remote)
+
+    leaves = MerkleTree.load(settings).diff(MerkleTree.load(remote))
+    tk_hashes = [leaf[5:] for leaf in leaves if leaf.startswith("task/")]
+    month_names = [leaf[6:] for leaf in leaves if leaf.startswith("month/")]
+
+    local_tasks = set(settings.storage.task_hashes())
+    remote_tasks = set(remote.storage.task_hashes())
+    sent, received, merged_count = 0, 0, 0
+    with TaskStore(settings), TaskStore(remote):
+        for tk_hash in tk_hashes:
+            # Held until the stores are flushed
+            TaskInfo.lock(tk_hash, settings)
+            TaskInfo.lock(tk_hash, remote)
+            if tk_hash not in remote_tasks:
+                copy_task(TaskInfo.load(tk_hash, settings), remote).save()
+                sent += 1
+            elif tk_hash not in local_tasks:
+                copy_task(TaskInfo.load(tk_hash, remote), settings).save()
+                received += 1
+            else:
+                merged = merge_tasks(TaskInfo.load(tk_hash, settings),
+                                     TaskInfo.load(tk_hash, remote))
+                merged.save()
+                copy_task(merged, remote).save()
+                merged_count += 1
+
+    renumbered_tasks = {}
+    for name in month_names:
+        date = month_date(name)
+        with MonthTasks.lock(date, settings), MonthTasks.lock(date, remote):
+            try:
+                ours = MonthTasks.load(date, settings)
+            except FileNotFoundError:
+                ours = None
+            try:
+                theirs = MonthTasks.load(date, remote)
+            except FileNotFoundError:
+                theirs = None
+
+            if ours is None:
+                month_tks = MonthTasks.from_json(theirs.to_json(), settings)
+                renumbered = {}
+            elif theirs is None:
+                month_tks, renumbered = ours, {}
+            else:
+                month_tks, renumbered = merge_months(ours, theirs, settings)
+
+            renumbered_tasks.update(renumbered)
+            month_tks.write()
+            MonthTasks.from_json(month_tks.to_json(), remote).write()
+
+    # Renumbered once every month is written
+    for tk_hash, id in renumbered_tasks.items():
+        for side in (settings, remote):
+            with edit_task(tk_hash, side) as tk:
+                tk.id = id
+                tk.save(compact=True)
+
+    for side in (settings, remote):
+        MerkleTree.load(side).save()
+    print(f"Sent {sent} tasks, received {received}, merged {merged_count}, "
+          f"{len(month_names)} months updated")
+
+def daemon_socket_path(settings):
+    return os.path.join(settings.config.path, "tau.sock")
+
+def send_message(f, message):
+    f.write(json.dumps(message).encode() + b"\n")
+    f.flush()
+
+def recv_message(f):
+    line = f.readline()
+    if not line:
+        return None
+    return json.loads(line)
+
+# Commands the daemon can run on behalf of a client.
+# Anything that needs the terminal (prompts, $EDITOR) runs locally.
+def can_forward(args):
+    if args.func in (cmd_list, cmd_show, cmd_start, cmd_pause, cmd_stop,
+                     cmd_log, cmd_projects, cmd_search, cmd_stats,
+                     cmd_rank, cmd_due):
+        return True
+    if args.func == cmd_add:
+        return args.title is not None and args.desc is not None
+    if args.func == cmd_comment:
+        return args.comment is not None
+    return False
+
+# Returns None when no daemon is listening
+def connect_daemon(settings):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(daemon_socket_path(settings))
+    except (FileNotFoundError, ConnectionRefusedError):
+        sock.close()
+        return None
+    return sock
+
+# Run the command in a running daemon. Returns the exit code, or None
+# when no daemon is listening or it doesn't take the command in time.
+#
+# The daemon says when it is ready before we send the command. Giving up
+# before then means closing without sending it, so a command never runs
+# both in the daemon and here.
+def forward_to_daemon(argv, settings):
+    sock = connect_daemon(settings)
+    if sock is None:
+        return None
 
-    tks = month.objects()
-    days_this_month = calendar.monthrange(date.year, date.month)[1]
-
-    #projects = {}
-    #for tk in tks:
-    #    if tk.project is None:
-    #        continue
-
-    #    # Select the main project category
-    #    # For example crypto.zk becomes crypto
-    #    project = tk.project.split(".")[0]
-
-    #    if project not in projects:
-    #        projects[project] = [False] * days_this_month
-
-    #    task_log = [False] * days_this_month
-    #    for event in tk.events:
-    #        event_day = event.timestamp.date().day
-    #        assert event_day - 1 < len(task_log)
-    #        if event.action == "start":
-    #            for i in range(event_day - 1, days_this_month):
-    #                task_log[i] = True
-    #        elif event.action == "pause" or event.action == "stop":
-    #            # Begin from the next day
-    #            for i in range(event_day, days_this_month):
-    #                task_log[i] = False
-
-    #    # Merge both logs.
-    #    project_log = []
-    #    for project_day, task_day in zip(projects[project], task_log):
-    #        if project_day:
-    #            project_log.append(True)
-    #        elif task_day:
-    #            project_log.append(True)
-    #        # Both are false
-    #        else:
-    #            project_log.append(False)
-
-    #    projects[project] = project_log
-
-    #    print(tk.project)
+    with sock, sock.makefile("rwb") as f:
+        sock.settimeout(DAEMON_WAIT_TIMEOUT)
+        try:
+            ready = recv_message(f)
+        except (OSError, ValueError) as e:
+            logging.info(f"daemon busy, running locally: {e}")
+            return None
+        if ready is None:
+            return None
+        sock.settimeout(None)
+        send_message(f, {"argv": argv})
+        reply = recv_message(f)
+    if reply is None:
+        error("daemon closed the connection")
+
+    sys.stdout.write(reply["stdout"])
+    sys.stderr.write(reply["stderr"])
+    return reply["code"]
+
+# Log records go to stream at level instead of the daemon's own handlers,
+# so a forwarded command logs to its client like it would have locally
+@contextlib.contextmanager
+def capture_logging(stream, level):
+    root = logging.getLogger()
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    handlers, old_level = root.handlers, root.level
+    root.handlers = [handler]
+    root.setLevel(level)
+    try:
+        yield
+    finally:
+        root.handlers = handlers
+        root.setLevel(old_level)
+
+def serve_request(parser, argv, settings):
+    import io
+    import traceback
+    stdout, stderr = io.StringIO(), io.StringIO()
+    code = 0
+    with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+        try:
+            args = parser.parse_args(argv)
+            with capture_logging(stderr, args.loglevel):
+                args.func(args, settings)
+        except SystemExit as e:
+            # error() and argparse both exit
+            if e.code is None:
+                code = 0
+            elif isinstance(e.code, int):
+                code = e.code
+            else:
+                print(e.code, file=sys.stderr)
+                code = 1
+        except Exception:
+            traceback.print_exc()
+            code = 1
+    return {
+        "stdout": stdout.getvalue(),
+        "stderr": stderr.getvalue(),
+        "code": code,
+    }
+
+def cmd_daemon(args, settings):
+    import signal
+    path = daemon_socket_path(settings)
+    sock = connect_daemon(settings)
+    if sock is not None:
+        sock.close()
+        error("daemon is already running")
+    # Remove a socket left behind by a daemon that died
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
 
-    table = []
-    for i in range(1, days_this_month + 1):
-        table.append((i, ))
-    print(tabulate(table))
+    # Keep loaded tasks and months in memory between requests
+    settings.memo = {}
+    parser = make_parser()
 
-def run_app():
+    # Clean up the socket on kill too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen()
+    logging.info(f"tau daemon listening on {path}")
+    try:
+        while True:
+            conn, _ = server.accept()
+            # Every other client waits while we serve this one
+            conn.settimeout(DAEMON_CLIENT_TIMEOUT)
+            # Closing flushes too, so it can fail like the sends
+            try:
+                with conn, conn.makefile("rwb") as f:
+                    send_message(f, {"ready": True})
+                    request = recv_message(f)
+                    if request is None:
+                        continue
+                    logging.debug(f"request: {request['argv']}")
+                    reply = serve_request(parser, request["argv"], settings)
+                    send_message(f, reply)
+            except (OSError, ValueError) as e:
+                logging.warning(f"dropped client: {e}")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.remove(path)
+
+# Set in the environment of the process profiled by --startup-profile
+STARTUP_PROFILE_ENV = "TAU_STARTUP_PROFILE"
+STARTUP_PHASES_PREFIX = "tau startup phases: "
+
+class PhaseTimer:
+
+    def __init__(self):
+        import threading
+        self.phases = []
+        self.start = self.last = time.perf_counter()
+        # Counted from the task loading threads too
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def mark(self, name):
+        now = time.perf_counter()
+        self.phases.append((name, now - self.last))
+        self.last = now
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def report(self):
+        print(STARTUP_PHASES_PREFIX + json.dumps(self.phases),
+              file=sys.stderr)
+
+    def metrics_json(self, command):
+        return {
+            "command": command,
+            "time": time.time(),
+            "total": time.perf_counter() - self.start,
+            "phases": self.phases,
+            "counters": self.counters,
+        }
+
+    def print_metrics(self):
+        for name, seconds in self.phases:
+            print(f"{name:>24}  {seconds * 1000:9.2f} ms", file=sys.stderr)
+        for name, value in sorted(self.counters.items()):
+            print(f"{name:>24}  {value:9}", file=sys.stderr)
+
+# Split the output of python -X importtime from the command's own stderr.
+# Returns [(module, depth, self_us, cumulative_us)] and the other lines.
+def parse_import_times(stderr):
+    imports = []
+    other = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            other.append(line)
+            continue
+        fields = line[len("import time:"):].split("|")
+        try:
+            self_us, cumulative_us = int(fields[0]), int(fields[1])
+        except ValueError:
+            # Column header
+            continue
+        name = fields[2].rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        imports.append((name.strip(), depth, self_us, cumulative_us))
+    return imports, other
+
+# Run the command again in a fresh interpreter with -X importtime
+# and report where the startup time went.
+def startup_profile(argv):
+    import subprocess
+
+    argv = [arg for arg in argv if arg != "--startup-profile"]
+    env = dict(os.environ)
+    env[STARTUP_PROFILE_ENV] = "1"
+    command = [sys.executable, "-X", "importtime",
+               os.path.abspath(__file__)] + argv
+
+    start = time.perf_counter()
+    proc = subprocess.run(command, env=env, stderr=subprocess.PIPE,
+                          text=True)
+    total = time.perf_counter() - start
+
+    imports, lines = parse_import_times(proc.stderr)
+    phases = []
+    for line in lines:
+        if line.startswith(STARTUP_PHASES_PREFIX):
+            phases = json.loads(line[len(STARTUP_PHASES_PREFIX):])
+        else:
+            print(line, file=sys.stderr)
+
+    top_level = [imp for imp in imports if imp[1] == 0]
+    top_level.sort(key=lambda imp: imp[3], reverse=True)
+    import_total = sum(imp[3] for imp in top_level) / 1e6
+
+    report = sys.stderr
+    print(f"startup profile: tau {' '.join(argv)}", file=report)
+    print(f"  {'total':<30} {total * 1000:8.1f} ms", file=report)
+    print(f"  {'imports':<30} {import_total * 1000:8.1f} ms", file=report)
+    for name, _, _, cumulative_us in top_level[:10]:
+        print(f"    {name:<28} {cumulative_us / 1000:8.1f} ms", file=report)
+    for name, seconds in phases:
+        print(f"  {name:<30} {seconds * 1000:8.1f} ms", file=report)
+    return proc.returncode
+
+def make_parser():
     parser = argparse.ArgumentParser(prog='tau',
         usage='%(prog)s [commands]',
         description="Collective task management cli"
@@ -642,6 +3836,21 @@ def run_app():
             action="store_const",
             dest="loglevel", const=logging.DEBUG, default=logging.WARNING,
             help="increase output verbosity"),
+    parser.add_argument("--no-daemon",
+            action="store_true",
+            help="access files directly even if a daemon is running")
+    parser.add_argument("--startup-profile",
+            action="store_true",
+            help="report import and startup times for the command")
+    parser.add_argument("--profile",
+            metavar="FILE", default=None,
+            help="run the command under cProfile and save the stats to FILE")
+    parser.add_argument("--metrics",
+            action="store_true",
+            help="print phase timings and read counters to stderr")
+    parser.add_argument("--metrics-file",
+            metavar="FILE", default=None,
+            help="append the metrics to FILE as a line of JSON")
     subparsers = parser.add_subparsers()
 
     # add [-a/--assign USER] [-p/--project zk] [-d/--due DDMM] [-r/--rank 4.87]
@@ -693,8 +3902,55 @@ def run_app():
         "project_prefix", nargs="?",
         default=None,
         help="project search prefix")
+    parser_list.add_argument(
+        "--project",
+        default=None,
+        help="project search prefix, same as the positional argument")
+    parser_list.add_argument(
+        "--since",
+        default=None,
+        help="list tasks from this month onwards: 0122")
+    parser_list.add_argument(
+        "--until",
+        default=None,
+        help="list tasks up to this month: 1222")
+    parser_list.add_argument(
+        "--state",
+        choices=["open", "start", "pause", "stop", "all"], default=None,
+        help="only tasks in this state, the default hides stopped tasks")
+    parser_list.add_argument(
+        "-a", "--assign",
+        default=None,
+        help="only tasks assigned to this user")
+    parser_list.add_argument(
+        "-n", "--limit",
+        type=int, default=None,
+        help="show at most this many tasks")
+    parser_list.add_argument(
+        "--offset",
+        type=int, default=0,
+        help="skip this many tasks first, for paging with --limit")
+    parser_list.add_argument(
+        "--format",
+        choices=["table", "plain", "tsv", "json"], default="table",
+        help="plain, tsv and json print without colors for scripts")
     parser_list.set_defaults(func=cmd_list)
 
+    parser_projects = subparsers.add_parser(
+        "projects", help="count open tasks per project")
+    parser_projects.set_defaults(func=cmd_projects)
+
+    parser_search = subparsers.add_parser(
+        "search", help="search titles, descriptions and comments")
+    parser_search.add_argument(
+        "terms", nargs="+",
+        help="words to search for")
+    parser_search.add_argument(
+        "-n", "--limit",
+        type=int, default=20,
+        help="maximum number of results")
+    parser_search.set_defaults(func=cmd_search)
+
     parser_show = subparsers.add_parser("show", help="show task by id")
     parser_show.add_argument(
         "id", nargs="?",
@@ -723,6 +3979,42 @@ def run_app():
         help="task id")
     parser_stop.set_defaults(func=cmd_stop)
 
+    parser_rank = subparsers.add_parser(
+        "rank", help="move a task above or below another")
+    parser_rank.add_argument(
+        "id",
+        type=int,
+        help="task id")
+    parser_rank.add_argument(
+        "--above",
+        type=int, default=None,
+        help="id of the task to go just above")
+    parser_rank.add_argument(
+        "--below",
+        type=int, default=None,
+        help="id of the task to go just below")
+    parser_rank.set_defaults(func=cmd_rank)
+
+    parser_due = subparsers.add_parser(
+        "due", help="open tasks due soon or overdue")
+    parser_due.add_argument(
+        "--within",
+        default="7d",
+        help="how far ahead to look: 7d, 2w")
+    parser_due.add_argument(
+        "--overdue",
+        action="store_true",
+        help="show tasks past their due date instead")
+    parser_due.add_argument(
+        "-a", "--assign",
+        default=None,
+        help="only tasks assigned to this person")
+    parser_due.add_argument(
+        "-s", "--summary",
+        action="store_true",
+        help="print a single line of counts, eg. for a shell prompt")
+    parser_due.set_defaults(func=cmd_due)
+
     parser_comment = subparsers.add_parser("comment", help="comment on task by id")
     parser_comment.add_argument(
         "id", nargs="?",
@@ -736,6 +4028,9 @@ def run_app():
         "-a", "--author",
         default=None,
         help="optional task author")
+    parser_comment.add_argument(
+        "-q", "--quiet", action="store_true",
+        help="don't print the task afterwards")
     parser_comment.set_defaults(func=cmd_comment)
 
     parser_log = subparsers.add_parser("log", help="log drawdown")
@@ -743,10 +4038,73 @@ def run_app():
         "date", nargs="?",
         default=None,
         help="task month in the format 0222")
+    parser_log.add_argument(
+        "until", nargs="?",
+        default=None,
+        help="last month to include, for logs spanning several months")
+    parser_log.add_argument(
+        "-d", "--depth",
+        type=int, default=1,
+        help="project levels to group by, 1 rolls crypto.zk into crypto")
     parser_log.set_defaults(func=cmd_log)
 
+    parser_stats = subparsers.add_parser(
+        "stats", help="time worked and time to finish")
+    parser_stats.add_argument(
+        "--since",
+        default=None,
+        help="first month to include: 0122, defaults to this month")
+    parser_stats.add_argument(
+        "--until",
+        default=None,
+        help="last month to include: 1222")
+    parser_stats.add_argument(
+        "-b", "--by",
+        choices=["task", "assign", "project"], default="project",
+        help="what to total the times for")
+    parser_stats.set_defaults(func=cmd_stats)
+
+    parser_sync = subparsers.add_parser(
+        "sync", help="exchange tasks with another tau directory")
+    parser_sync.add_argument(
+        "path",
+        help="the other config directory, eg. a shared mount")
+    parser_sync.set_defaults(func=cmd_sync)
+
+    parser_batch = subparsers.add_parser(
+        "batch", help="apply operations from a JSONL file in one go")
+    parser_batch.add_argument(
+        "file", nargs="?",
+        default=None,
+        help="file of operations, defaults to stdin")
+    parser_batch.set_defaults(func=cmd_batch)
+
+    parser_reindex = subparsers.add_parser(
+        "reindex", help="rebuild the task index from the task directory")
+    parser_reindex.set_defaults(func=cmd_reindex)
+
+    parser_migrate = subparsers.add_parser(
+        "migrate", help="convert the JSON task tree to an SQLite database")
+    parser_migrate.set_defaults(func=cmd_migrate)
+
+    parser_daemon = subparsers.add_parser(
+        "daemon", help="serve commands from memory over a unix socket")
+    parser_daemon.set_defaults(func=cmd_daemon)
+
+    return parser
+
+def run_app():
+    timer = PhaseTimer()
+    if os.environ.get(STARTUP_PROFILE_ENV):
+        atexit.register(timer.report)
+
+    parser = make_parser()
     args = parser.parse_args()
     logging.basicConfig(level=args.loglevel)
+    timer.mark("parse arguments")
+
+    if args.startup_profile:
+        sys.exit(startup_profile(sys.argv[1:]))
 
     # TODO: load config, only steps until #2 for now. Do #3 onwards later
     # weaker priority than command line args
@@ -775,10 +4133,12 @@ def run_app():
     make_path(config_path)
     make_path(config_path, "task")
     make_path(config_path, "month")
+    make_path(config_path, "journal")
 
     config = Config(config_path)
     config.load()
     settings = Settings(config)
+    timer.mark("load settings")
 
     try: 
         # Check the subcommand was actually specified
@@ -788,8 +4148,48 @@ def run_app():
         parser.print_help()
         return
 
+    measured = args.metrics or args.metrics_file is not None
+    if measured:
+        settings.metrics = timer
+
+    # Measurements are of this process, so don't hand the command over
+    if (not args.no_daemon and not measured and args.profile is None and
+        can_forward(args)):
+        code = forward_to_daemon(sys.argv[1:], settings)
+        if code is not None:
+            timer.mark("forward to daemon")
+            sys.exit(code)
+
     # Actually run the command
-    args.func(args, settings)
+    try:
+        if args.profile is None:
+            args.func(args, settings)
+        else:
+            run_profiled(args, settings)
+    finally:
+        timer.mark("run command")
+        if measured:
+            report_metrics(args, timer)
+
+def run_profiled(args, settings):
+    import cProfile
+    import pstats
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.runcall(args.func, args, settings)
+    finally:
+        profiler.dump_stats(args.profile)
+        stats = pstats.Stats(profiler, stream=sys.stderr)
+        stats.sort_stats("cumulative").print_stats(20)
+
+def report_metrics(args, timer):
+    if args.metrics:
+        timer.print_metrics()
+    if args.metrics_file is not None:
+        command = args.func.__name__.removeprefix("cmd_")
+        with open(args.metrics_file, "a") as f:
+            f.write(json.dumps(timer.metrics_json(command)) + "\n")
 
 if __name__ == "__main__":
     run_app()
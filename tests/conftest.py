@@ -0,0 +1,54 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TAU_PATH = os.path.join(ROOT, "tau.py")
+sys.path.insert(0, ROOT)
+
+# Seconds before a tau process counts as hung
+TIMEOUT = 60
+
+@pytest.fixture
+def store(tmp_path):
+    return str(tmp_path / "store")
+
+# Extra environment variables override the defaults
+def tau_env(store, **env):
+    return {**os.environ, "TAU_CONFIG_PATH": store, "TAU_CACHE": "0", **env}
+
+def start_tau(store, *argv, stdin=None, **env):
+    return subprocess.Popen(
+        [sys.executable, TAU_PATH, "--no-daemon"] + list(argv),
+        env=tau_env(store, **env), stdin=stdin, stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE, text=True)
+
+# Wait for processes started together, killing them all if any hangs
+def wait_all(procs):
+    results = []
+    try:
+        for proc in procs:
+            stdout, stderr = proc.communicate(timeout=TIMEOUT)
+            results.append((proc.returncode, stdout, stderr))
+    except subprocess.TimeoutExpired:
+        for proc in procs:
+            proc.kill()
+        pytest.fail("tau hung")
+    return results
+
+def run_tau(store, *argv, **env):
+    [result] = wait_all([start_tau(store, *argv, **env)])
+    return result
+
+def write_batch(path, ops):
+    with open(path, "w") as f:
+        for op in ops:
+            f.write(json.dumps(op) + "\n")
+    return str(path)
+
+def task_count(store):
+    return len([name for name in os.listdir(os.path.join(store, "task"))
+                if not name.startswith(".")])
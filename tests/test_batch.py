@@ -0,0 +1,56 @@
+import pytest
+
+from conftest import run_tau, write_batch, task_count
+from tau import Real, batch_operation, cmd_add, cmd_comment
+
+def test_add_rank():
+    func, args = batch_operation(1, {"op": "add", "title": "a", "rank": 2.5})
+    assert func is cmd_add
+    assert args.rank == Real("2.5")
+    assert args.project is None
+
+def test_comment_is_quiet():
+    func, args = batch_operation(1, {"op": "comment", "id": 0,
+                                     "comment": "halfway"})
+    assert func is cmd_comment
+    assert args.quiet
+
+@pytest.mark.parametrize("data, message", [
+    ([1, 2], "line 3: expected an object"),
+    ("add", "line 3: expected an object"),
+    ({"op": "fly"}, "line 3: unknown operation fly"),
+    ({"op": "start", "id": 0, "at": 1}, "line 3: unknown field at"),
+    ({"op": "add"}, "line 3: add needs a title"),
+    ({"op": "add", "title": "a", "rank": "abc"}, "line 3: invalid rank abc"),
+    ({"op": "add", "title": "a", "rank": [1]}, "line 3: invalid rank [1]"),
+    ({"op": "add", "title": "a", "rank": "NaN"}, "line 3: invalid rank NaN"),
+    ({"op": "comment", "id": 0}, "line 3: comment needs a comment"),
+])
+def test_invalid_lines(data, message, capsys):
+    with pytest.raises(SystemExit):
+        batch_operation(3, data)
+    assert capsys.readouterr().err == f"Error: {message}\n"
+
+# A bad line rolls back the whole batch rather than crashing half way
+def test_invalid_rank_applies_nothing(store, tmp_path):
+    batch = write_batch(tmp_path / "batch.jsonl", [
+        {"op": "add", "title": "a"},
+        {"op": "add", "title": "b", "rank": "abc"},
+    ])
+    run_tau(store, "add", "-t", "x", "--desc", "x")
+    code, _, stderr = run_tau(store, "batch", batch)
+    assert code != 0
+    assert stderr == "Error: line 2: invalid rank abc\n"
+    assert task_count(store) == 1
+
+def test_batched_comments_print_nothing(store, tmp_path):
+    batch = write_batch(tmp_path / "batch.jsonl", [
+        {"op": "comment", "id": 0, "comment": "one"},
+        {"op": "comment", "id": 0, "comment": "two"},
+    ])
+    run_tau(store, "add", "-t", "x", "--desc", "x")
+    code, stdout, _ = run_tau(store, "batch", batch)
+    assert code == 0
+    assert stdout == ""
+    code, stdout, _ = run_tau(store, "show", "0")
+    assert "one" in stdout and "two" in stdout
@@ -0,0 +1,38 @@
+import os
+import time
+
+from conftest import run_tau
+
+# Three entries fit, a prune leaves two
+CACHE_ENV = {"TAU_CACHE": "1", "TAU_CACHE_SIZE": "3"}
+
+def cache_entries(store):
+    return set(os.listdir(os.path.join(store, "cache")))
+
+# Show a task and return the name of the cache entry it added, if any
+def show(store, id):
+    before = cache_entries(store)
+    code, _, _ = run_tau(store, "show", str(id), **CACHE_ENV)
+    assert code == 0
+    [name] = cache_entries(store) - before
+    return name
+
+def test_prune_keeps_recently_used(store):
+    for i in range(4):
+        run_tau(store, "add", "-t", f"task {i}", "--desc", "x")
+    os.makedirs(os.path.join(store, "cache"))
+    entries = [show(store, id) for id in range(3)]
+
+    # Oldest first, as if they had been read a while ago in that order
+    now = time.time()
+    for age, name in zip([3000, 2000, 1000], entries):
+        path = os.path.join(store, "cache", name)
+        os.utime(path, (now - age, now - age))
+    # A hit on the oldest makes it the most recently used
+    assert run_tau(store, "show", "0", **CACHE_ENV)[0] == 0
+
+    last = show(store, 3)
+    assert cache_entries(store) == {entries[0], last}
+
+    # Still caching after a prune
+    assert show(store, 1) == entries[1]
@@ -0,0 +1,42 @@
+import os
+import subprocess
+import sys
+import time
+
+from conftest import TAU_PATH, TIMEOUT, tau_env
+
+def start_daemon(store):
+    os.makedirs(store)
+    proc = subprocess.Popen([sys.executable, TAU_PATH, "-v", "daemon"],
+                            env=tau_env(store), stderr=subprocess.PIPE,
+                            text=True)
+    path = os.path.join(store, "tau.sock")
+    deadline = time.monotonic() + TIMEOUT
+    while not os.path.exists(path):
+        assert proc.poll() is None and time.monotonic() < deadline
+        time.sleep(0.05)
+    return proc
+
+def run_client(store, *argv):
+    return subprocess.run([sys.executable, TAU_PATH] + list(argv),
+                          env=tau_env(store), capture_output=True, text=True,
+                          timeout=TIMEOUT)
+
+# Log records of a forwarded command reach the client at the client's
+# level, the daemon's stderr only has its own
+def test_forwarded_logs_go_to_client(store):
+    daemon = start_daemon(store)
+    try:
+        quiet = run_client(store, "add", "-t", "quiet", "--desc", "x")
+        loud = run_client(store, "-v", "add", "-t", "loud", "--desc", "x")
+    finally:
+        daemon.terminate()
+        _, daemon_log = daemon.communicate(timeout=TIMEOUT)
+
+    assert quiet.returncode == 0 and loud.returncode == 0
+    assert quiet.stderr == ""
+    assert loud.stderr.startswith("INFO:root:TaskInfo {")
+    assert "title: loud" in loud.stderr
+    # Both ran in the daemon, which logs the requests but not their records
+    assert daemon_log.count("DEBUG:root:request:") == 2
+    assert "TaskInfo" not in daemon_log
@@ -0,0 +1,36 @@
+from conftest import run_tau, start_tau, wait_all, write_batch, task_count
+
+# Each batch locks task 0 and the month in the opposite order to the
+# other, which deadlocked while locks were taken in operation order
+def test_batches_in_opposite_order(store, tmp_path):
+    first = write_batch(tmp_path / "first.jsonl", [
+        {"op": "add", "title": "a"}, {"op": "start", "id": 0},
+        {"op": "add", "title": "a"}, {"op": "pause", "id": 0},
+    ] * 3)
+    second = write_batch(tmp_path / "second.jsonl", [
+        {"op": "pause", "id": 0}, {"op": "add", "title": "b"},
+        {"op": "start", "id": 0}, {"op": "add", "title": "b"},
+    ] * 3)
+    run_tau(store, "add", "-t", "x", "--desc", "x")
+
+    for _ in range(10):
+        results = wait_all([start_tau(store, "batch", first),
+                            start_tau(store, "batch", second)])
+        assert [code for code, _, _ in results] == [0, 0], results
+    assert task_count(store) == 1 + 10 * 12
+
+# Single commands lock the month before the task, like a batch does
+def test_batch_against_single_commands(store, tmp_path):
+    batch = write_batch(tmp_path / "batch.jsonl", [
+        {"op": "start", "id": 0}, {"op": "add", "title": "a"},
+        {"op": "pause", "id": 0}, {"op": "add", "title": "a"},
+    ] * 5)
+    run_tau(store, "add", "-t", "x", "--desc", "x")
+
+    procs = [start_tau(store, "batch", batch)]
+    for _ in range(5):
+        procs.append(start_tau(store, "add", "-t", "c", "--desc", "c"))
+        procs.append(start_tau(store, "start", "0"))
+    results = wait_all(procs)
+    assert all(code == 0 for code, _, _ in results), results
+    assert task_count(store) == 1 + 10 + 5
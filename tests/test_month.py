@@ -0,0 +1,78 @@
+import datetime
+
+from tau import MonthTasks
+
+def new_month():
+    return MonthTasks(datetime.datetime(2024, 3, 1), None)
+
+def claim(month_tks, tk_hash):
+    id = month_tks.find_free_id()
+    month_tks.claim_id(id, tk_hash)
+    return id
+
+def test_ids_count_up():
+    month_tks = new_month()
+    assert [claim(month_tks, tk_hash) for tk_hash in "abc"] == [0, 1, 2]
+    assert month_tks.lookup_id(1) == "b"
+
+def test_lowest_released_id_is_reused():
+    month_tks = new_month()
+    for tk_hash in "abcd":
+        claim(month_tks, tk_hash)
+    month_tks.release_id(2, "c")
+    month_tks.release_id(0, "a")
+    assert claim(month_tks, "e") == 0
+    assert claim(month_tks, "f") == 2
+    assert claim(month_tks, "g") == 4
+    assert month_tks.lookup_id(0) == "e"
+
+def test_claim_past_next_id_frees_the_gap():
+    month_tks = new_month()
+    month_tks.claim_id(3, "a")
+    assert month_tks.next_id == 4
+    assert [claim(month_tks, tk_hash) for tk_hash in "bcde"] == [0, 1, 2, 4]
+
+def test_claim_from_middle_of_free_list():
+    month_tks = new_month()
+    month_tks.claim_id(5, "a")
+    month_tks.claim_id(3, "b")
+    assert [claim(month_tks, tk_hash) for tk_hash in "cdef"] == [0, 1, 2, 4]
+
+# A stop that lost the race with another stop and an add must leave the
+# id alone, it now belongs to the new task
+def test_release_of_reused_id_is_ignored():
+    month_tks = new_month()
+    claim(month_tks, "a")
+    month_tks.release_id(0, "a")
+    assert claim(month_tks, "b") == 0
+    month_tks.release_id(0, "a")
+    assert month_tks.lookup_id(0) == "b"
+    assert claim(month_tks, "c") == 1
+
+def test_release_twice():
+    month_tks = new_month()
+    claim(month_tks, "a")
+    month_tks.release_id(0, "a")
+    month_tks.release_id(0, "a")
+    assert month_tks.free_ids == [0]
+
+def test_roll_over_keeps_open_ids():
+    previous = new_month()
+    for tk_hash in "abcd":
+        claim(previous, tk_hash)
+    previous.release_id(1, "b")
+    previous.release_id(3, "d")
+    month_tks = MonthTasks(datetime.datetime(2024, 4, 1), None)
+    month_tks.roll_over(previous)
+    assert month_tks.ids == {0: "a", 2: "c"}
+    assert month_tks.task_tks == ["a", "c"]
+    assert [claim(month_tks, tk_hash) for tk_hash in "ef"] == [1, 3]
+
+def test_json_round_trip():
+    month_tks = new_month()
+    for tk_hash in "abc":
+        claim(month_tks, tk_hash)
+    month_tks.release_id(1, "b")
+    copy = MonthTasks.from_json(month_tks.to_json(), None)
+    assert copy.ids == month_tks.ids
+    assert claim(copy, "d") == 1
@@ -0,0 +1,39 @@
+import pytest
+
+from tau import RANK_PLACES, Real, spread_ranks
+
+def ranks(*values):
+    return [Real(value) for value in values]
+
+@pytest.mark.parametrize("low, high, count, expected", [
+    # As few decimal places as keep them apart
+    ("1", "2", 1, ranks("1.5")),
+    ("1", "2", 3, ranks("1.2", "1.5", "1.8")),
+    ("1", "2", 10, ranks("1.09", "1.18", "1.27", "1.36", "1.45", "1.55",
+                         "1.64", "1.73", "1.82", "1.91")),
+    # Whole numbers of room above the highest rank
+    ("1", None, 2, ranks("2", "3")),
+    ("1.5", None, 1, ranks("2")),
+    # Down towards 0 but not past it, above the unranked tasks
+    (None, "0.5", 1, ranks("0.2")),
+    (None, "3", 2, ranks("1", "2")),
+    # Unless the ranks given by hand are already below 0
+    (None, "-3", 2, ranks("-5", "-4")),
+    (None, None, 3, ranks("1", "2", "3")),
+])
+def test_spread_ranks(low, high, count, expected):
+    low = None if low is None else Real(low)
+    high = None if high is None else Real(high)
+    assert spread_ranks(low, high, count) == expected
+
+def test_too_narrow():
+    gap = Real(1).scaleb(-RANK_PLACES)
+    assert spread_ranks(Real(1), Real(1) + gap, 1) is None
+
+@pytest.mark.parametrize("count", [1, 2, 7, 50, 999])
+def test_strictly_between(count):
+    low, high = Real("2.5"), Real("7.25")
+    spread = spread_ranks(low, high, count)
+    bounds = [low] + spread + [high]
+    assert all(a < b for a, b in zip(bounds, bounds[1:]))
+    assert all(-rank.as_tuple().exponent <= RANK_PLACES for rank in spread)
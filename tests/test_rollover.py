@@ -0,0 +1,48 @@
+import datetime
+import json
+import os
+
+from conftest import run_tau, start_tau, wait_all
+
+def month_path(store, date):
+    return os.path.join(store, "month", date.strftime("%m%y"))
+
+# Move everything this month holds back into the previous month, as if
+# the tasks had been made then and this month had not started yet
+def move_to_previous_month(store):
+    now = datetime.datetime.now()
+    previous = now.replace(day=1) - datetime.timedelta(days=1)
+    with open(month_path(store, now)) as f:
+        data = json.load(f)
+    data["created_at"] = previous.timestamp()
+    with open(month_path(store, previous), "w") as f:
+        json.dump(data, f)
+    os.remove(month_path(store, now))
+    return data
+
+# Many tau at once find the month missing. They must all agree on one
+# month which carries the open tasks over with their ids.
+def test_concurrent_rollover(store):
+    for i in range(4):
+        run_tau(store, "add", "-t", f"old {i}", "--desc", "x")
+    run_tau(store, "stop", "1")
+    previous = move_to_previous_month(store)
+
+    results = wait_all([start_tau(store, "add", "-t", f"new {i}",
+                                  "--desc", "x") for i in range(8)])
+    assert [code for code, _, _ in results] == [0] * 8, results
+
+    with open(month_path(store, datetime.datetime.now())) as f:
+        data = json.load(f)
+    ids = {int(id): tk_hash for id, tk_hash in data["ids"].items()}
+    assert len(ids) == 3 + 8
+    assert sorted(ids) == list(range(11))
+    for id in ("0", "2", "3"):
+        assert ids[int(id)] == previous["ids"][id]
+    assert sorted(data["tasks"]) == sorted(ids.values())
+    assert data["free_ids"] == []
+    assert data["next_id"] == 11
+
+    # Carried over tasks are still found by their id
+    code, stdout, _ = run_tau(store, "show", "2")
+    assert code == 0 and "old 2" in stdout
@@ -0,0 +1,38 @@
+import json
+import os
+import re
+
+from conftest import run_tau
+
+def search_titles(store, *terms):
+    code, stdout, _ = run_tau(store, "search", *terms)
+    assert code == 0
+    return [re.split(r"\s\s+", line.strip())[1]
+            for line in stdout.splitlines()[2:]]
+
+def test_saves_keep_the_index_current(store):
+    run_tau(store, "add", "-t", "walrus ladder", "--desc", "x")
+    run_tau(store, "add", "-t", "other", "--desc", "walrus")
+    assert search_titles(store, "walrus") == ["walrus ladder", "other"]
+
+    run_tau(store, "comment", "1", "-c", "heron", "-q")
+    assert search_titles(store, "heron") == ["other"]
+    meta = json.load(open(os.path.join(store, "search", "meta")))
+    assert meta["docs"] == 2
+
+# Tasks from before the index, or an index in an older layout, are
+# picked up by a rebuild on the next search
+def test_older_index_is_rebuilt(store):
+    run_tau(store, "add", "-t", "walrus ladder", "--desc", "x")
+    search = os.path.join(store, "search")
+    os.makedirs(os.path.join(search, "docs"))
+    for name in os.listdir(search):
+        if name.startswith("docs-"):
+            os.remove(os.path.join(search, name))
+    with open(os.path.join(search, "meta"), "w") as f:
+        json.dump({"docs": 0}, f)
+
+    run_tau(store, "add", "-t", "walrus pen", "--desc", "x")
+    assert sorted(search_titles(store, "walrus")) == ["walrus ladder",
+                                                      "walrus pen"]
+    assert not os.path.exists(os.path.join(search, "docs"))